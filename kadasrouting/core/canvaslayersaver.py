@@ -9,6 +9,31 @@ from qgis.core import (
 )
 from PyQt5.QtGui import QColor
 from kadasrouting.utilities import transformToWGS, pushWarning
+from kadasrouting.core.layerregistry import LayerRegistry, addLegacyMatcher
+
+# Purpose of the layers saved from the canvas in the layer registry, where
+# the run id is the name given to the layer
+CANVAS_LAYER_PURPOSE = "canvas_layer"
+# Fields of the layers saved from the canvas
+CANVAS_LAYER_FIELDS = ["centerx", "centery", "interval"]
+
+
+def _legacyLayerKey(layer):
+    """
+    Purpose and run id of the canvas layers saved before the layer registry
+    existed, recognized by their provider, geometry and fields
+    """
+    if (
+        isinstance(layer, QgsVectorLayer)
+        and layer.providerType() == "memory"
+        and layer.geometryType() == QgsWkbTypes.PolygonGeometry
+        and layer.fields().names() == CANVAS_LAYER_FIELDS
+    ):
+        return CANVAS_LAYER_PURPOSE, layer.name()
+    return None
+
+
+addLegacyMatcher(_legacyLayerKey)
 
 
 class CanvasLayerSaver:
@@ -28,32 +53,35 @@ class CanvasLayerSaver:
         self.addPolygonLayer()
 
     def addPolygonLayer(self):
-        try:
-            # FIXME: we do not consider if there are several layers with the same name here
-            existinglayer = QgsProject.instance().mapLayersByName(self.name)[0]
+        registry = LayerRegistry.getInstance()
+        existinglayer = registry.layer(CANVAS_LAYER_PURPOSE, self.name)
+        if existinglayer is not None:
             QgsProject.instance().removeMapLayer(existinglayer.id())
-        except IndexError:
-            # if such layer does not exist we can pass over
-            pass
         # arbitrary decision taken: WGS84 for these layers
         self.layer = QgsVectorLayer(
-            "Polygon?crs=epsg:4326&field=centerx:double&field=centery:double&field=interval:double",
+            "MultiPolygon?crs=epsg:4326&field=centerx:double&field=centery:double&field=interval:double",
             self.name,
             "memory",
         )
         pr = self.layer.dataProvider()
-        if self.features:
-            for feature in self.features:
-                if isinstance(feature, QgsFeature):
-                    geom = feature.geometry()
-                    feature.setGeometry(self.reprojectToWGS84(geom))
-                    pr.addFeatures([feature])
-                elif isinstance(feature, QgsGeometry):
-                    qgsFeature = QgsFeature()
-                    qgsFeature.setGeometry(self.reprojectToWGS84(feature))
-                    pr.addFeatures([qgsFeature])
+        features = []
+        for feature in self.features or []:
+            if isinstance(feature, QgsFeature):
+                geom = self.reprojectToWGS84(feature.geometry())
+                feature = QgsFeature(feature)
+            elif isinstance(feature, QgsGeometry):
+                geom = self.reprojectToWGS84(feature)
+                feature = QgsFeature()
+            else:
+                continue
+            if geom is not None:
+                feature.setGeometry(geom)
+                features.append(feature)
+        if features:
+            pr.addFeatures(features)
 
         self.layer.updateExtents()
+        registry.register(self.layer, CANVAS_LAYER_PURPOSE, self.name)
         QgsProject.instance().addMapLayer(self.layer)
         if self.style:
             self.layer.loadNamedStyle(self.style)
@@ -69,25 +97,18 @@ class CanvasLayerSaver:
             self.layer.setRenderer(renderer)
 
     def reprojectToWGS84(self, geom):
+        """
+        Returns a copy of a polygon geometry transformed to WGS84, as a
+        multipolygon so parts and holes are kept, or None if it is not a
+        polygon geometry.
+        """
         geomType = geom.type()
-        if geomType == QgsWkbTypes.LineGeometry:
-            geomList = geom.asPolyline()
-        elif geomType == QgsWkbTypes.PolygonGeometry:
-            geomList = geom.asPolygon()
-        newGeom = []
-        for j in range(len(geomList)):
-            if geomType == QgsWkbTypes.LineGeometry:
-                newGeom.append(self.transformer.transform(geomList[j]))
-            elif geomType == QgsWkbTypes.PolygonGeometry:
-                line = geomList[j]
-                for i in range(len(line)):
-                    point = line[i]
-                    newGeom.append(self.transformer.transform(point))
-        if geomType == QgsWkbTypes.LineGeometry:
-            return QgsGeometry.fromPolylineXY(newGeom)
-        elif geomType == QgsWkbTypes.PolygonGeometry:
-            return QgsGeometry.fromPolygonXY([newGeom])
-        else:
+        if geomType != QgsWkbTypes.PolygonGeometry:
             # TODO, from qgis 3.18 it will be possible to use the method
             # QgsWkbTypes.translatedDisplayString() to have much nicer error message
             pushWarning("not implemented: cannot save layer type: {}".format(geomType))
+            return None
+        newGeom = QgsGeometry(geom)
+        newGeom.transform(self.transformer)
+        newGeom.convertToMultiType()
+        return newGeom
@@ -1,19 +1,27 @@
 import json
+import struct
 import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
-from PyQt5.QtCore import QTextCodec
 from PyQt5.QtGui import QColor
 
-from kadasrouting.utilities import waitcursor, tr
+from kadasrouting.utilities import waitcursor, tr, transformToWGS
 
 from kadasrouting.valhalla.client import ValhallaClient
+from kadasrouting.core.routemodel import METERS_PER_DEGREE
+from kadasrouting.core.layerregistry import LayerRegistry, addLegacyMatcher
+from kadasrouting.core.memorylayersaver import ensureLayerLoaded
 
 from qgis.core import (
     QgsProject,
+    QgsSettings,
     QgsWkbTypes,
-    QgsSingleSymbolRenderer,
+    QgsCategorizedSymbolRenderer,
+    QgsRendererCategory,
+    QgsSymbol,
     QgsFeature,
-    QgsJsonUtils,
     QgsVectorLayer,
     QgsGeometry,
     QgsSvgMarkerSymbolLayer,
@@ -22,6 +30,18 @@ from qgis.core import (
 
 LOG = logging.getLogger(__name__)
 
+# Purposes of the isochrones layers in the layer registry, where the run id is
+# the basename of the layers
+ISOCHRONES_PURPOSE = "isochrones"
+CENTER_PURPOSE = "isochrones_center"
+
+# Maximum number of isochrones computed at the same time for a layer of centers
+ISOCHRONES_MAX_WORKERS = 4
+# Maximum number of isochrone polygons kept in the cache
+ISOCHRONES_CACHE_SIZE = 500
+# Fields of the isochrones layers
+ISOCHRONES_FIELDS = ["centerid", "centerx", "centery", "interval"]
+
 
 class OverwriteError(Exception):
     pass
@@ -30,79 +50,340 @@ class OverwriteError(Exception):
 valhalla = ValhallaClient.getInstance()
 
 
-def getFeaturesFromResponse(response):
-    """Return a list of features from a valhalla response object"""
-    codec = QTextCodec.codecForName("UTF-8")
-    fields = QgsJsonUtils.stringToFields(json.dumps(response), codec)
-    features = QgsJsonUtils.stringToFeatureList(json.dumps(response), fields, codec)
-    return features
+class IsochronesCache:
+    """
+    Cache of the computed isochrone polygons, keyed by center, profile,
+    costing options, map package and interval, so a run around a center
+    already used only computes the intervals that were not computed yet.
+    The least recently used polygons are dropped first.
+    """
 
+    def __init__(self, maxSize=ISOCHRONES_CACHE_SIZE):
+        self.maxSize = maxSize
+        self._geometries = OrderedDict()
+        self._lock = threading.Lock()
 
-@waitcursor
-def generateIsochrones(
-    point, profile, costingOptions, intervals, colors, basename, overwrite=True
+    @staticmethod
+    def runKey(point, profile, costingOptions, tilesID, generalize, denoise):
+        return (
+            round(point.x(), 7),
+            round(point.y(), 7),
+            profile,
+            json.dumps(costingOptions, sort_keys=True),
+            tilesID,
+            generalize,
+            denoise,
+        )
+
+    def get(self, runKey, interval):
+        key = runKey + (float(interval),)
+        with self._lock:
+            geometry = self._geometries.get(key)
+            if geometry is not None:
+                self._geometries.move_to_end(key)
+            return geometry
+
+    def put(self, runKey, interval, geometry):
+        with self._lock:
+            self._geometries[runKey + (float(interval),)] = geometry
+            while len(self._geometries) > self.maxSize:
+                self._geometries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._geometries.clear()
+
+
+_cache = IsochronesCache()
+
+
+_WKB_POLYGON = 3
+_WKB_MULTIPOLYGON = 6
+
+
+def _ringWkb(ring):
+    coords = [c for point in ring for c in point[:2]]
+    return struct.pack("<I%dd" % len(coords), len(ring), *coords)
+
+
+def _polygonWkb(rings):
+    return struct.pack("<BII", 1, _WKB_POLYGON, len(rings)) + b"".join(
+        _ringWkb(ring) for ring in rings
+    )
+
+
+def geometryFromGeoJson(geometry):
+    """
+    Builds a QgsGeometry from a GeoJSON Polygon or MultiPolygon geometry
+    (as a dict), going through WKB instead of parsing JSON text.
+    """
+    if geometry["type"] == "Polygon":
+        wkb = _polygonWkb(geometry["coordinates"])
+    elif geometry["type"] == "MultiPolygon":
+        polygons = geometry["coordinates"]
+        wkb = struct.pack("<BII", 1, _WKB_MULTIPOLYGON, len(polygons)) + b"".join(
+            _polygonWkb(rings) for rings in polygons
+        )
+    else:
+        raise ValueError(
+            "Unsupported isochrone geometry type: {}".format(geometry["type"])
+        )
+    qgsgeometry = QgsGeometry()
+    qgsgeometry.fromWkb(wkb)
+    return qgsgeometry
+
+
+def isochronesFromResponse(response):
+    """
+    Returns a list of (contour, color, geometry) tuples from a valhalla
+    isochrones response, with the contour (the interval) and the color as
+    given in the properties of each feature.
+    """
+    isochrones = []
+    for feature in response["features"]:
+        properties = feature.get("properties", {})
+        isochrones.append(
+            (
+                properties.get("contour"),
+                properties.get("color"),
+                geometryFromGeoJson(feature["geometry"]),
+            )
+        )
+    return isochrones
+
+
+def _centerLayerName(basename):
+    return tr("Center of {basename}").format(basename=basename)
+
+
+def _legacyLayerKey(layer):
+    """
+    Purpose and run id of the isochrones and center layers saved before the
+    layer registry existed, recognized by their provider, geometry and fields
+    """
+    if not isinstance(layer, QgsVectorLayer) or layer.providerType() != "memory":
+        return None
+    if layer.geometryType() == QgsWkbTypes.PolygonGeometry:
+        if layer.fields().names() == ISOCHRONES_FIELDS:
+            return ISOCHRONES_PURPOSE, layer.name()
+    elif layer.geometryType() == QgsWkbTypes.PointGeometry:
+        prefix, _, suffix = tr("Center of {basename}").partition("{basename}")
+        name = layer.name()
+        if (
+            not layer.fields().count()
+            and len(name) > len(prefix) + len(suffix)
+            and name.startswith(prefix)
+            and name.endswith(suffix)
+        ):
+            return CENTER_PURPOSE, name[len(prefix): len(name) - len(suffix)]
+    return None
+
+
+addLegacyMatcher(_legacyLayerKey)
+
+
+def _removeExistingLayer(purpose, runId, overwrite):
+    existinglayer = LayerRegistry.getInstance().layer(purpose, runId)
+    if existinglayer is None:
+        LOG.debug("no {} layer for run {}".format(purpose, runId))
+        return
+    if overwrite:
+        QgsProject.instance().removeMapLayer(existinglayer.id())
+    else:
+        raise OverwriteError(
+            tr(
+                "layer {layername} already exists and overwrite is {overwrite}"
+            ).format(layername=existinglayer.name(), overwrite=overwrite)
+        )
+
+
+def _intervalSymbol(color):
+    outlineColor = QColor(0, 0, 0)
+    symbol = QgsSymbol.defaultSymbol(QgsWkbTypes.PolygonGeometry)
+    if color:
+        # Set opacity to 75% or C0 in hex (25% transparency)
+        symbol.setColor(QColor("#C0" + color.lstrip("#")))
+    symbol.symbolLayer(0).setStrokeColor(outlineColor)
+    return symbol
+
+
+def simplifyIsochrones(isochrones, tolerance):
+    """
+    Simplifies the isochrones around a center, keeping them nested. The
+    simplification preserves the topology of each polygon (GEOS
+    TopologyPreserveSimplify), but not between polygons, so each polygon is
+    then clipped to the simplified polygon of the next larger interval.
+
+    :param isochrones: (interval, color, geometry) tuples, from the largest
+        interval to the smallest one
+    :param tolerance: The simplification tolerance, in meters
+    """
+    tolerance = tolerance / METERS_PER_DEGREE
+    simplified = []
+    outer = None
+    for interval, color, geometry in isochrones:
+        simplifiedGeometry = geometry.simplify(tolerance)
+        if simplifiedGeometry.isEmpty():
+            # the polygon is smaller than the tolerance
+            simplifiedGeometry = geometry
+        if outer is not None:
+            simplifiedGeometry = simplifiedGeometry.intersection(outer)
+            # the intersection can be a collection, with lines or points
+            # where the polygons touch
+            simplifiedGeometry.convertGeometryCollectionToSubclass(
+                QgsWkbTypes.PolygonGeometry
+            )
+        simplified.append((interval, color, simplifiedGeometry))
+        outer = simplifiedGeometry
+    return simplified
+
+
+def _computeIsochrones(
+    point, profile, costingOptions, intervals, colors, tilesID, polygonOptions
 ):
-    response = valhalla.isochrones(point, profile, costingOptions, intervals, colors)
-    features = getFeaturesFromResponse(response)
+    """
+    Returns (interval, color, geometry) tuples with the isochrones around a
+    point, from the largest interval to the smallest one. The intervals in
+    the cache are not computed again, the missing ones are requested
+    together.
+
+    :param polygonOptions: The "generalize" and "denoise" options of Valhalla
+        and the "simplify" tolerance (in meters) of the client-side
+        simplification, if any of them is set
+    """
+    generalize = polygonOptions.get("generalize")
+    denoise = polygonOptions.get("denoise")
+    runKey = _cache.runKey(
+        point, profile, costingOptions, tilesID, generalize, denoise
+    )
+    intervalColors = dict(zip(intervals, colors))
+    geometries = {}
+    missing = []
+    for interval in intervals:
+        geometry = _cache.get(runKey, interval)
+        if geometry is None:
+            missing.append(interval)
+        else:
+            geometries[interval] = geometry
+    if missing:
+        LOG.debug("computing isochrones for intervals {}".format(missing))
+        missingColors = [intervalColors[i] for i in missing if i in intervalColors]
+        response = valhalla.isochrones(
+            point,
+            profile,
+            costingOptions,
+            missing,
+            missingColors,
+            generalize,
+            denoise,
+        )
+        byContour = {float(i): i for i in missing}
+        for contour, color, geometry in isochronesFromResponse(response):
+            try:
+                interval = byContour.get(float(contour))
+            except (TypeError, ValueError):
+                # e.g. a feature without contour property
+                interval = None
+            if interval is None:
+                LOG.debug("unexpected isochrone contour: {}".format(contour))
+                continue
+            _cache.put(runKey, interval, geometry)
+            geometries[interval] = geometry
+            intervalColors.setdefault(interval, color)
+    isochrones = [
+        (interval, intervalColors.get(interval), geometries[interval])
+        for interval in intervals[::-1]
+        if interval in geometries
+    ]
+    if polygonOptions.get("simplify"):
+        isochrones = simplifyIsochrones(isochrones, polygonOptions["simplify"])
+    return isochrones
+
+
+def _createIsochronesLayer(layername, centers, isochrones, intervals, costingOptions):
+    """
+    Creates a single polygon layer with the isochrones of all the centers,
+    with the id of the center and the interval as attributes and a renderer
+    with a category (and color) per interval.
+
+    :param centers: (center id, center point) tuples, in the same order as
+        the isochrones
+    :param isochrones: for each center, the (interval, color, geometry)
+        tuples returned by _computeIsochrones
+    """
+    layer = QgsVectorLayer(
+        "MultiPolygon?crs=epsg:4326&field=centerid:integer&field=centerx:double"
+        "&field=centery:double&field=interval:double",
+        layername,
+        "memory",
+    )
+    qgsfeatures = []
+    intervalColors = {}
+    for (centerid, point), centerIsochrones in zip(centers, isochrones):
+        for interval, color, geometry in centerIsochrones:
+            qgsfeature = QgsFeature(layer.fields())
+            qgsfeature.setAttributes([centerid, point.x(), point.y(), interval])
+            geometry = QgsGeometry(geometry)
+            geometry.convertToMultiType()
+            qgsfeature.setGeometry(geometry)
+            qgsfeatures.append(qgsfeature)
+            intervalColors[interval] = color
+    ok, _ = layer.dataProvider().addFeatures(qgsfeatures)
+    if not ok:
+        raise Exception(
+            tr("Could not add the isochrones to layer {layername}").format(
+                layername=layername
+            )
+        )
+    layer.updateExtents()
+
     if costingOptions.get("shortest"):
         suffix = "km"
     else:
         suffix = "min"
-    for interval, feature in zip(intervals[::-1], features):
-        # FIXME: we should use the 'contour' property in the feature to be sure of the contour line that we are
-        # drawing, but due to a bug in qgis json parser, this property appears to be always set to '0'
-        layername = "{} {} - {}".format(interval, suffix, basename)
-        try:
-            # FIXME: we do not consider if there are several layers with the same name here
-            existinglayer = QgsProject.instance().mapLayersByName(layername)[0]
-            if overwrite:
-                QgsProject.instance().removeMapLayer(existinglayer.id())
-            else:
-                raise OverwriteError(
-                    tr(
-                        "layer {layername} already exists and overwrite is {overwrite}"
-                    ).format(layername=layername, overwrite=overwrite)
-                )
-        except IndexError:
-            LOG.debug("this layer was not found: {}".format(layername))
-
-        layer = QgsVectorLayer(
-            "Polygon?crs=epsg:4326&field=centerx:double&field=centery:double&field=interval:double",
-            layername,
-            "memory",
+    categories = [
+        QgsRendererCategory(
+            interval,
+            _intervalSymbol(intervalColors[interval]),
+            "{} {}".format(interval, suffix),
         )
-        pr = layer.dataProvider()
-        qgsfeature = QgsFeature()
-        qgsfeature.setAttributes([point.x(), point.y(), interval])
-        qgsfeature.setGeometry(feature.geometry())
-        pr.addFeatures([qgsfeature])
-        layer.updateExtents()
-        QgsProject.instance().addMapLayer(layer)
-        outlineColor = QColor(0, 0, 0)
-        # Set opacity to 75% or C0 in hex (25% transparency)
-        fillColor = QColor("#C0" + feature["color"][1:])
-        renderer = QgsSingleSymbolRenderer.defaultRenderer(QgsWkbTypes.PolygonGeometry)
-        symbol = renderer.symbol()
-        symbol.setColor(fillColor)
-        symbol.symbolLayer(0).setStrokeColor(outlineColor)
-        layer.setRenderer(renderer)
+        for interval in intervals
+        if interval in intervalColors
+    ]
+    layer.setRenderer(QgsCategorizedSymbolRenderer("interval", categories))
+    return layer
+
+
+@waitcursor
+def generateIsochrones(
+    point,
+    profile,
+    costingOptions,
+    intervals,
+    colors,
+    basename,
+    overwrite=True,
+    polygonOptions=None,
+):
+    """
+    Computes the isochrones around a point and adds them to the project as a
+    single layer with a feature per interval, together with a layer with the
+    center point.
+    """
+    tilesID = QgsSettings().value("/kadasrouting/activeValhallaTilesID")
+    isochrones = _computeIsochrones(
+        point, profile, costingOptions, intervals, colors, tilesID, polygonOptions or {}
+    )
+    _removeExistingLayer(ISOCHRONES_PURPOSE, basename, overwrite)
+    layer = _createIsochronesLayer(
+        basename, [(None, point)], [isochrones], intervals, costingOptions
+    )
+    LayerRegistry.getInstance().register(layer, ISOCHRONES_PURPOSE, basename)
+    QgsProject.instance().addMapLayer(layer)
 
     # Add center of reachability
-    center_point_layer_name = tr("Center of {basename}").format(basename=basename)
-    try:
-        existinglayer = QgsProject.instance().mapLayersByName(center_point_layer_name)[
-            0
-        ]
-        if overwrite:
-            QgsProject.instance().removeMapLayer(existinglayer.id())
-        else:
-            raise OverwriteError(
-                tr(
-                    "layer {layername} already exists and overwrite is {overwrite}"
-                ).format(layername=center_point_layer_name, overwrite=overwrite)
-            )
-    except IndexError:
-        LOG.debug("this layer was not found: {}".format(center_point_layer_name))
+    center_point_layer_name = _centerLayerName(basename)
+    _removeExistingLayer(CENTER_PURPOSE, basename, overwrite)
 
     center_point = QgsVectorLayer(
         "Point?crs=epsg:4326",
@@ -119,4 +400,57 @@ def generateIsochrones(
     symbol.setSize(10)
     symbol.setVerticalAnchorPoint(QgsMarkerSymbolLayer.Bottom)
     center_point.renderer().symbol().changeSymbolLayer(0, symbol)
+    LayerRegistry.getInstance().register(center_point, CENTER_PURPOSE, basename)
     QgsProject.instance().addMapLayer(center_point)
+
+
+@waitcursor
+def generateIsochronesForLayer(
+    centerLayer,
+    profile,
+    costingOptions,
+    intervals,
+    colors,
+    basename,
+    overwrite=True,
+    polygonOptions=None,
+):
+    """
+    Computes the isochrones for each point of a layer and stores them all in
+    a single polygon layer, with the id of the center feature and the interval
+    as attributes. The isochrones of the different centers are computed in
+    parallel.
+    """
+    transformer = transformToWGS(centerLayer.crs())
+    centers = []
+    ensureLayerLoaded(centerLayer)
+    for feature in centerLayer.getFeatures():
+        if feature.hasGeometry():
+            point = feature.geometry().centroid().asPoint()
+            centers.append((feature.id(), transformer.transform(point)))
+    if not centers:
+        raise Exception(
+            tr("Layer {layername} has no points").format(layername=centerLayer.name())
+        )
+
+    tilesID = QgsSettings().value("/kadasrouting/activeValhallaTilesID")
+
+    def isochronesForCenter(center):
+        return _computeIsochrones(
+            center[1],
+            profile,
+            costingOptions,
+            intervals,
+            colors,
+            tilesID,
+            polygonOptions or {},
+        )
+
+    with ThreadPoolExecutor(max_workers=ISOCHRONES_MAX_WORKERS) as executor:
+        isochrones = list(executor.map(isochronesForCenter, centers))
+
+    _removeExistingLayer(ISOCHRONES_PURPOSE, basename, overwrite)
+    layer = _createIsochronesLayer(basename, centers, isochrones, intervals, costingOptions)
+    LayerRegistry.getInstance().register(layer, ISOCHRONES_PURPOSE, basename)
+    QgsProject.instance().addMapLayer(layer)
+    return layer
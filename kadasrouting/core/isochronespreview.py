@@ -0,0 +1,55 @@
+import logging
+
+from qgis.core import QgsTask
+
+from kadasrouting.utilities import tr
+from kadasrouting.valhalla.client import ValhallaClient
+from kadasrouting.core.isochroneslayer import isochronesFromResponse
+
+LOG = logging.getLogger(__name__)
+
+# Tolerance in meters used to generalize the preview polygons, coarser than
+# the one used for the isochrones layers so the preview is computed and drawn
+# faster
+PREVIEW_GENERALIZE = 500
+
+
+class IsochronesPreviewTask(QgsTask):
+    """
+    Computes in the background coarse isochrones around a point, to be shown
+    as a preview. A task whose preview is not needed anymore is canceled; as
+    the Valhalla request itself can not be interrupted, its result is then
+    just discarded.
+    """
+
+    def __init__(self, point, profile, costingOptions, intervals, colors):
+        QgsTask.__init__(self, tr("Computing isochrones preview"), QgsTask.CanCancel)
+        self.point = point
+        self.profile = profile
+        self.costingOptions = dict(costingOptions)
+        self.intervals = intervals
+        self.colors = colors
+        self.isochrones = None
+        self.exception = None
+
+    def run(self):
+        try:
+            response = ValhallaClient.getInstance().isochrones(
+                self.point,
+                self.profile,
+                self.costingOptions,
+                self.intervals,
+                self.colors,
+                PREVIEW_GENERALIZE,
+            )
+        except Exception as e:
+            self.exception = e
+            return False
+        if self.isCanceled():
+            return False
+        self.isochrones = isochronesFromResponse(response)
+        return not self.isCanceled()
+
+    def finished(self, result):
+        if not result and self.exception is not None:
+            LOG.debug("Could not compute isochrones preview: %s" % self.exception)
@@ -0,0 +1,131 @@
+import logging
+
+from qgis.core import QgsProject
+
+LOG = logging.getLogger(__name__)
+
+# Layer custom properties, saved with the layers in the project, used to
+# rebuild the registry when a project is read
+PURPOSE_PROPERTY = "kadasrouting/purpose"
+RUN_ID_PROPERTY = "kadasrouting/runId"
+
+# Functions recognizing the layers created by the plugin before the registry
+# existed, returning their (purpose, run id) or None
+_legacyMatchers = []
+
+
+def addLegacyMatcher(matcher):
+    """
+    Adds a function used to tag the layers of projects saved before the
+    registry existed. It is given an untagged layer and returns the
+    (purpose, run id) of that layer, or None if it was not created for that
+    purpose.
+    """
+    _legacyMatchers.append(matcher)
+
+
+class LayerRegistry:
+    """
+    Index of the layers created by the plugin, keyed by their purpose (e.g.
+    "isochrones") and the id of the run that created them (e.g. the basename
+    of the isochrones), so they can be found without going through all the
+    layers of the project and without relying on the layer names, which the
+    user can change or repeat.
+
+    The purpose and run id are stored as custom properties of the layers, so
+    the registry follows the layers added to and removed from the project,
+    including when a project is read. Untagged layers of older projects are
+    tagged once, when the project is read, by the legacy matchers.
+    """
+
+    __instance = None
+
+    @staticmethod
+    def getInstance():
+        if LayerRegistry.__instance is None:
+            LayerRegistry()
+        return LayerRegistry.__instance
+
+    @staticmethod
+    def reset():
+        """Disconnects the registry from the project, when the plugin is unloaded"""
+        if LayerRegistry.__instance is not None:
+            LayerRegistry.__instance.disconnect()
+            LayerRegistry.__instance = None
+
+    def __init__(self):
+        if LayerRegistry.__instance is not None:
+            raise Exception("Singleton class")
+        LayerRegistry.__instance = self
+        self._layerIds = {}
+        self._keys = {}
+        project = QgsProject.instance()
+        project.layersAdded.connect(self._layersAdded)
+        project.layersWillBeRemoved.connect(self._layersRemoved)
+        project.readProject.connect(self._projectRead)
+        self._layersAdded(project.mapLayers().values())
+        self.migrateLegacyLayers()
+
+    def disconnect(self):
+        project = QgsProject.instance()
+        project.layersAdded.disconnect(self._layersAdded)
+        project.layersWillBeRemoved.disconnect(self._layersRemoved)
+        project.readProject.disconnect(self._projectRead)
+
+    def migrateLegacyLayers(self):
+        """
+        Tags and registers the untagged layers of the project recognized by
+        a legacy matcher, unless a layer is already registered for the same
+        purpose and run.
+        """
+        for layer in QgsProject.instance().mapLayers().values():
+            if layer.customProperty(PURPOSE_PROPERTY):
+                continue
+            for matcher in _legacyMatchers:
+                key = matcher(layer)
+                if key is not None:
+                    if key not in self._layerIds:
+                        LOG.debug(
+                            "registering layer {} as {} {}".format(layer.name(), *key)
+                        )
+                        self.register(layer, *key)
+                    break
+
+    def register(self, layer, purpose, runId):
+        """
+        Registers a layer for a purpose and run. It replaces in the registry
+        any other layer registered with the same purpose and run, but that
+        layer is not removed from the project.
+        """
+        layer.setCustomProperty(PURPOSE_PROPERTY, purpose)
+        layer.setCustomProperty(RUN_ID_PROPERTY, runId)
+        self._index(layer.id(), (purpose, runId))
+
+    def layer(self, purpose, runId):
+        """Returns the layer registered for a purpose and run, or None"""
+        layerId = self._layerIds.get((purpose, runId))
+        if layerId is None:
+            return None
+        return QgsProject.instance().mapLayer(layerId)
+
+    def _index(self, layerId, key):
+        previousKey = self._keys.pop(layerId, None)
+        if previousKey is not None:
+            self._layerIds.pop(previousKey, None)
+        self._layerIds[key] = layerId
+        self._keys[layerId] = key
+
+    def _layersAdded(self, layers):
+        for layer in layers:
+            purpose = layer.customProperty(PURPOSE_PROPERTY)
+            if purpose:
+                self._index(layer.id(), (purpose, layer.customProperty(RUN_ID_PROPERTY)))
+
+    def _projectRead(self, document):
+        self.migrateLegacyLayers()
+
+    def _layersRemoved(self, layerIds):
+        for layerId in layerIds:
+            key = self._keys.pop(layerId, None)
+            if key is not None and self._layerIds.get(key) == layerId:
+                del self._layerIds[key]
@@ -4,115 +4,498 @@ https://github.com/ccrook/QGIS-MemoryLayerSaver-Plugin
 """
 
 from PyQt5.QtWidgets import QMessageBox
-from PyQt5.QtCore import QObject, QIODevice, QFile, QDataStream, QFileInfo
-from qgis.core import QgsField, QgsFeature, QgsGeometry, QgsMapLayer, QgsProject, Qgis
+from PyQt5.QtCore import (
+    QObject,
+    QIODevice,
+    QFile,
+    QDataStream,
+    QByteArray,
+    QTimer,
+)
+from qgis.core import (
+    QgsField,
+    QgsFeature,
+    QgsGeometry,
+    QgsRectangle,
+    QgsMapLayer,
+    QgsProject,
+    QgsMessageLog,
+    QgsSettings,
+    QgsCoordinateTransform,
+    QgsCsException,
+    Qgis,
+)
+from array import array
+from functools import partial
+import os
 import sys
+import mmap
+import zlib
+import struct
+import logging
+import threading
+
+LOG = logging.getLogger(__name__)
 
 
 QString = str
 
+# The saver attached to the project, see ensureLayerLoaded
+_saver = None
+
+# Version of the MLD format written. Version 3 stores the attributes column
+# by column and the geometries as a table of sizes followed by a single WKB
+# block, version 4 adds a directory with the position of each layer in the
+# file, version 5 allows compressed layer records, version 6 only compresses
+# the features so the schema of a layer can be read without decompressing
+# them, versions 1 and 2 (a record per feature) can still be read.
+FORMAT_VERSION = 6
+READABLE_VERSIONS = (1, 2, 3, 4, 5, 6)
+# Number of features added at once to the memory provider when reading
+READ_BATCH_SIZE = 10000
+# The features of compressed records are made of zlib blocks of
+# COMPRESSION_BLOCK_SIZE bytes, each one with its size, compressed size and
+# CRC32
+COMPRESSION_BLOCK_SIZE = 1 << 20
+COMPRESSION_LEVEL = 6
+_BLOCK_HEADER = struct.Struct("<III")
+# The changed layers are appended to the previous file, whose records of the
+# other layers are kept in place, as long as those records take at least
+# this share of the file, otherwise a new file is written
+APPEND_MIN_USED_RATIO = 0.5
+# Size of the chunks the records are copied by from the previous file
+COPY_CHUNK_SIZE = 1 << 20
+
+
+def _uint32Bytes(values):
+    # little endian, whatever the platform
+    a = array("I", values)
+    if sys.byteorder == "big":
+        a.byteswap()
+    return a.tobytes()
+
+
+def _uint32Array(data):
+    a = array("I")
+    a.frombytes(data)
+    if sys.byteorder == "big":
+        a.byteswap()
+    return a
+
+
+def _bufferToQByteArray():
+    try:
+        QByteArray(memoryview(b""))
+        return QByteArray
+    except TypeError:
+        # older PyQt versions only convert bytes
+        return lambda view: QByteArray(bytes(view))
+
+
+# Copies a buffer slice (e.g. a memoryview) in a QByteArray, once if PyQt
+# accepts buffers
+_qbytes = _bufferToQByteArray()
+
+
+def _wkbSize(feat):
+    if not feat.hasGeometry():
+        return 0
+    try:
+        return feat.geometry().constGet().wkbSize()
+    except AttributeError:
+        # before QGIS 3.16
+        return len(feat.geometry().asWkb())
+
+
+def _writeFully(file, data):
+    if file.write(data) != len(data):
+        raise IOError("Cannot write " + file.fileName() + ": " + file.errorString())
+
+
+def _decompressBlock(data, rawSize, crc, filename):
+    try:
+        raw = zlib.decompress(data)
+    except zlib.error:
+        raise ValueError(filename + " is corrupted")
+    if len(raw) != rawSize or zlib.crc32(raw) != crc:
+        raise ValueError(filename + " is corrupted")
+    return raw
+
+
+class RecordWriter:
+    """
+    Writes the features of a layer record to a file by blocks of COMPRESSION_BLOCK_SIZE
+    bytes, compressed as soon as they are complete if compress is True, so
+    only one block of the record is kept in memory.
+    """
+
+    def __init__(self, file, compress):
+        self._file = file
+        self._compress = compress
+        self._block = bytearray()
+        # size of the features before compression
+        self.size = 0
+
+    def write(self, data):
+        view = memoryview(data)
+        self.size += len(view)
+        if self._block:
+            missing = COMPRESSION_BLOCK_SIZE - len(self._block)
+            self._block += view[:missing]
+            view = view[missing:]
+            if len(self._block) < COMPRESSION_BLOCK_SIZE:
+                return
+            self._writeBlock(self._block)
+            self._block = bytearray()
+        while len(view) >= COMPRESSION_BLOCK_SIZE:
+            self._writeBlock(view[:COMPRESSION_BLOCK_SIZE])
+            view = view[COMPRESSION_BLOCK_SIZE:]
+        self._block += view
+
+    def close(self):
+        if self._block:
+            self._writeBlock(self._block)
+            self._block = bytearray()
+
+    def _writeBlock(self, raw):
+        if not self._compress:
+            _writeFully(self._file, bytes(raw))
+            return
+        compressed = zlib.compress(raw, COMPRESSION_LEVEL)
+        _writeFully(
+            self._file, _BLOCK_HEADER.pack(len(raw), len(compressed), zlib.crc32(raw))
+        )
+        _writeFully(self._file, compressed)
+
+
+class BufferStream:
+    """
+    Reads a record from a buffer, with the methods of QDataStream used to
+    read the header of a record, so the buffer is not copied in a QByteArray
+    """
+
+    def __init__(self, buffer, pos=0):
+        self._buffer = buffer
+        self._pos = pos
+
+    def pos(self):
+        return self._pos
+
+    def _unpack(self, fmt):
+        (value,) = struct.unpack_from(fmt, self._buffer, self._pos)
+        self._pos += struct.calcsize(fmt)
+        return value
+
+    def readInt16(self):
+        return self._unpack(">h")
+
+    def readUInt32(self):
+        return self._unpack(">I")
+
+    def readUInt64(self):
+        return self._unpack(">Q")
+
+    def readQString(self):
+        size = self.readUInt32()
+        if size == 0xFFFFFFFF:
+            # null string
+            return ""
+        value = bytes(self._buffer[self._pos: self._pos + size]).decode("utf-16-be")
+        self._pos += size
+        return value
+
+    def skipRawData(self, size):
+        self._pos += size
+
 
 class Writer(QObject):
-    def __init__(self, filename):
+    """
+    Writes a memory layers file. In append mode, the records of an existing
+    file are kept and the new records and the directory are written after
+    them, the header pointing to the new directory once it is on disk.
+    """
+
+    def __init__(self, filename, compress=False, append=False):
         QObject.__init__(self, None)
         self._filename = filename
+        self._compress = compress
+        self._append = append
         self._file = None
         self._dstream = None
+        self._directoryOffsetPos = None
+        self._directory = []
+        # size of the file once complete, known when the directory is written
+        self._size = None
+        # size of the existing file in append mode, and whether its header
+        # points to the new directory
+        self._keptSize = None
+        self._committed = False
 
     def __enter__(self):
         self.open()
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        self.close
+        if exc_type is None:
+            try:
+                self.writeDirectory()
+            except Exception:
+                self.abort()
+                raise
+            self.close()
+        else:
+            self.abort()
 
     def open(self):
         self._file = QFile(self._filename)
-        if not self._file.open(QIODevice.WriteOnly):
+        mode = QIODevice.ReadWrite if self._append else QIODevice.WriteOnly
+        if not self._file.open(mode):
             raise ValueError("Cannot open " + self._filename)
         self._dstream = QDataStream(self._file)
         self._dstream.setVersion(QDataStream.Qt_4_5)
+        self._directory = []
+        self._committed = False
+        if self._append:
+            # after the magic string and the version
+            self._directoryOffsetPos = len(b"QGis.MemoryLayerData") + 4
+            self._keptSize = self._file.size()
+            self._file.seek(self._keptSize)
+            return
         for c in b"QGis.MemoryLayerData":
             self._dstream.writeUInt8(c)
         # Version of MLD format
-        self._dstream.writeUInt32(2)
+        self._dstream.writeUInt32(FORMAT_VERSION)
+        # Offset of the directory, known once all the layers are written
+        self._directoryOffsetPos = self._file.pos()
+        self._dstream.writeUInt64(0)
+        self._checkStream()
+
+    def _checkStream(self):
+        if self._dstream.status() != QDataStream.Ok:
+            raise IOError(
+                "Cannot write " + self._filename + ": " + self._file.errorString()
+            )
+
+    def writeDirectory(self):
+        """
+        Writes at the end of the file the directory of the layers: the id,
+        offset and size of the record of each layer and a map of metadata,
+        and its offset in the header.
+        """
+        ds = self._dstream
+        directoryOffset = self._file.pos()
+        ds.writeUInt32(len(self._directory))
+        for layerId, offset, size, metadata in self._directory:
+            ds.writeQString(layerId)
+            ds.writeUInt64(offset)
+            ds.writeUInt64(size)
+            ds.writeQVariant(metadata)
+        self._size = self._file.pos()
+        self._checkStream()
+        if self._append:
+            # the previous directory stays valid until the new one is on disk
+            self._sync(self._file)
+        self._committed = True
+        self._file.seek(self._directoryOffsetPos)
+        ds.writeUInt64(directoryOffset)
+        self._file.seek(self._size)
+        self._checkStream()
+
+    def _sync(self, file):
+        if not file.flush():
+            raise IOError("Cannot write " + self._filename + ": " + file.errorString())
+        os.fsync(file.handle())
 
     def close(self):
+        """Closes the file once its data is on disk, raises IOError if not"""
+        file = self._file
+        self._dstream.setDevice(None)
+        self._dstream = None
+        self._file = None
+        try:
+            # make sure the data is on disk before the file replaces another
+            self._sync(file)
+        finally:
+            file.close()
+        if file.error() != QFile.NoError:
+            raise IOError("Cannot close " + self._filename + ": " + file.errorString())
+
+    def abort(self):
+        """Closes an incomplete file, without raising, as an error is raised"""
+        if self._file is None:
+            return
         try:
             self._dstream.setDevice(None)
+            if self._append and not self._committed:
+                # drop what was appended, the file is the previous one again
+                self._file.resize(self._keptSize)
             self._file.close()
-        except:  # noqa: E722
-            pass
+        except Exception as e:
+            LOG.warning("Error closing {}: {}".format(self._filename, e))
         self._dstream = None
         self._file = None
 
+    def verify(self):
+        """
+        Checks that the closed file has the expected size and directory,
+        e.g. before it replaces another
+        """
+        if self._size is None or os.path.getsize(self._filename) != self._size:
+            raise IOError(self._filename + " is incomplete")
+        with Reader(self._filename) as reader:
+            if reader.layerIds() != set(entry[0] for entry in self._directory):
+                raise IOError(self._filename + " is incomplete")
+
     def writeLayers(self, layers):
         for layer in layers:
             self.writeLayer(layer)
 
+    def copyLayer(self, layerId, reader):
+        """
+        Copies the (possibly compressed) record of a layer from the file of a
+        reader, chunk by chunk
+        """
+        if not self._dstream:
+            raise ValueError("Layer stream not open for writing")
+        offset = self._file.pos()
+        for chunk in reader.readRecordChunks(layerId):
+            _writeFully(self._file, chunk)
+        _, size, metadata = reader.layerEntry(layerId)
+        self._directory.append((layerId, offset, size, metadata))
+
+    def keepLayer(self, layerId, offset, size, metadata):
+        """Keeps the record of a layer already in the file, in append mode"""
+        if not self._append:
+            raise ValueError("Layer records can only be kept in append mode")
+        self._directory.append((layerId, offset, size, metadata))
+
     def writeLayer(self, layer):
+        self.writeSnapshot(LayerSnapshot(layer))
+
+    def writeSnapshot(self, snapshot):
         if not self._dstream:
-            raise ValueError("Layer stream not open for reading")
+            raise ValueError("Layer stream not open for writing")
+        offset = self._file.pos()
+        # the header is never compressed, so the schema can be read alone
         ds = self._dstream
-        dp = layer.dataProvider()
-        ss = layer.subsetString()
-        attr = dp.attributeIndexes()
-        ds.writeQString(layer.id())
-        ds.writeQString(ss)
-        ds.writeInt16(len(attr))
-        flds = dp.fields()  # noqa: F841
-        fldnames = []
-        for i in attr:
-            fld = dp.fields()[i]
-            fldnames.append(fld.name())
+        ds.writeQString(snapshot.id)
+        ds.writeQString(snapshot.subsetString)
+        ds.writeInt16(len(snapshot.fields))
+        for fld in snapshot.fields:
             ds.writeQString(fld.name())
             ds.writeInt16(int(fld.type()))
             ds.writeQString(fld.typeName())
             ds.writeInt16(fld.length())
             ds.writeInt16(fld.precision())
             ds.writeQString(fld.comment())
+        self._checkStream()
 
-        layer.setSubsetString("")
-        feats = layer.getFeatures()
+        record = RecordWriter(self._file, self._compress)
+        feats = snapshot.features
+
+        # attributes, column by column, in a block prefixed by its size so
+        # it can be skipped
+        columns = QByteArray()
+        cs = QDataStream(columns, QIODevice.WriteOnly)
+        cs.setVersion(QDataStream.Qt_4_5)
+        values = [feat.attributes() for feat in feats]
+        for index in snapshot.indexes:
+            for featValues in values:
+                cs.writeQVariant(featValues[index] if index >= 0 else None)
+        del values
+        record.write(struct.pack(">IQ", len(feats), columns.size()))
+        record.write(columns.data())
+        del columns
+
+        # geometries, as a table of WKB sizes (0 for no geometry) followed by
+        # all the WKB, encoded one by one as they are written
+        sizes = [_wkbSize(feat) for feat in feats]
+        record.write(_uint32Bytes(sizes))
+        record.write(struct.pack(">Q", sum(sizes)))
+        for feat, size in zip(feats, sizes):
+            if size:
+                wkb = feat.geometry().asWkb().data()
+                if len(wkb) != size:
+                    raise ValueError("Unexpected WKB size in layer " + snapshot.id)
+                record.write(wkb)
+        record.close()
+
+        metadata = {"featureCount": len(feats)}
+        extent = QgsRectangle()
+        extent.setMinimal()
+        hasGeometry = False
         for feat in feats:
-            ds.writeBool(True)
-            if attr:
-                for field in fldnames:
-                    try:
-                        ds.writeQVariant(feat[field])
-                    except KeyError:
-                        ds.writeQVariant(None)
-            geom = feat.geometry()
-            if not geom:
-                ds.writeUInt32(0)
-            else:
-                wkb = geom.asWkb()
-                ds.writeUInt32(len(wkb))
-                ds.writeRawData(wkb)
-        ds.writeBool(False)
-        layer.setSubsetString(ss)
+            if feat.hasGeometry():
+                extent.combineExtentWith(feat.geometry().boundingBox())
+                hasGeometry = True
+        if hasGeometry:
+            # so the layer can be registered without reading its features
+            metadata["extent"] = [
+                extent.xMinimum(),
+                extent.yMinimum(),
+                extent.xMaximum(),
+                extent.yMaximum(),
+            ]
+        if self._compress:
+            metadata["compression"] = "zlib"
+            # so the features can be decompressed in a buffer of the right size
+            metadata["rawSize"] = record.size
+        self._directory.append(
+            (snapshot.id, offset, self._file.pos() - offset, metadata)
+        )
+
+
+class LayerSnapshot:
+    """
+    The schema and features of a memory layer, taken on the main thread so
+    they can be written on another thread. Features are implicitly shared,
+    so copying them is cheap and later edits of the layer do not change
+    them.
+    """
+
+    def __init__(self, layer):
+        dp = layer.dataProvider()
+        self.id = layer.id()
+        self.subsetString = layer.subsetString()
+        self.fields = [QgsField(dp.fields()[i]) for i in dp.attributeIndexes()]
+        layerFields = layer.fields()
+        self.indexes = [layerFields.indexOf(fld.name()) for fld in self.fields]
+        layer.setSubsetString("")
+        self.features = list(layer.getFeatures())
+        layer.setSubsetString(self.subsetString)
 
 
 class Reader(QObject):
     def __init__(self, filename):
         self._filename = filename
         self._file = None
+        # stream of the file, and stream of the record being read: the file
+        # stream, or a stream of the decompressed record of a version 5 file
+        self._fstream = None
         self._dstream = None
+        # decompressed version 5 record being read, None when read from the
+        # file
+        self._record = None
+        # offset, size and metadata of the record being read, if in the
+        # directory
+        self._entry = None
         self._version = None
+        self._directory = None
 
     def __enter__(self):
         self.open()
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        self.close
+        self.close()
 
     def open(self):
         self._file = QFile(self._filename)
         if not self._file.open(QIODevice.ReadOnly):
             raise ValueError("Cannot open " + self._filename)
-        self._dstream = QDataStream(self._file)
-        self._dstream.setVersion(QDataStream.Qt_4_5)
+        self._fstream = QDataStream(self._file)
+        self._fstream.setVersion(QDataStream.Qt_4_5)
+        self._dstream = self._fstream
         for c in b"QGis.MemoryLayerData":
 
             ct = self._dstream.readUInt8()
@@ -121,25 +504,146 @@ class Reader(QObject):
                     self._filename + " is not a valid memory layer data file"
                 )
         version = self._dstream.readInt32()
-        if version not in (1, 2):
+        if version not in READABLE_VERSIONS:
             raise ValueError(
                 self._filename
                 + " is not compatible with this version of the MemoryLayerSaver plugin"
             )
         self._version = version
+        if version > 3:
+            self.readDirectory()
+
+    def readDirectory(self):
+        ds = self._fstream
+        directoryOffset = ds.readUInt64()
+        if directoryOffset == 0:
+            raise ValueError(self._filename + " is incomplete")
+        self._file.seek(directoryOffset)
+        self._directory = {}
+        for i in range(ds.readUInt32()):
+            layerId = ds.readQString()
+            offset = ds.readUInt64()
+            size = ds.readUInt64()
+            metadata = ds.readQVariant()
+            self._directory[layerId] = (offset, size, metadata)
 
     def close(self):
         try:
-            self._dstream.setDevice(None)
+            self._fstream.setDevice(None)
             self._file.close()
         except:  # noqa: E722
             pass
+        self._fstream = None
         self._dstream = None
+        self._record = None
+        self._entry = None
         self._file = None
 
+    def filename(self):
+        return self._filename
+
+    def version(self):
+        return self._version
+
+    def hasDirectory(self):
+        return self._directory is not None
+
+    def layerIds(self):
+        return set(self._directory or ())
+
+    def layerMetadata(self, layerId):
+        entry = (self._directory or {}).get(layerId)
+        return None if entry is None else entry[2]
+
+    def size(self):
+        return self._file.size()
+
+    def layerEntry(self, layerId):
+        """Returns the offset, size and metadata of the record of a layer"""
+        return self._directory[layerId]
+
+    def readRecordChunks(self, layerId):
+        """
+        Yields the record of a layer by chunks of at most COPY_CHUNK_SIZE
+        bytes, without decoding or decompressing it
+        """
+        offset, size, metadata = self._directory[layerId]
+        self._file.seek(offset)
+        while size > 0:
+            chunk = self._file.read(min(size, COPY_CHUNK_SIZE))
+            if not chunk:
+                raise ValueError(self._filename + " is truncated")
+            size -= len(chunk)
+            yield chunk
+
+    def isCompressed(self, layerId):
+        metadata = self._directory[layerId][2] or {}
+        return metadata.get("compression") == "zlib"
+
+    def hasPlainSchema(self, layerId):
+        """
+        Whether the schema of a layer in the directory can be read without
+        decompressing its record, which version 5 files compress entirely
+        """
+        return self._version > 5 or not self.isCompressed(layerId)
+
+    def _seekRecord(self, layerId):
+        """
+        Makes the record of a layer in the directory the one read, after its
+        layer id
+        """
+        offset, size, metadata = self._directory[layerId]
+        self._entry = (offset, size, metadata or {})
+        self._file.seek(offset)
+        if not self.hasPlainSchema(layerId):
+            self._record = self._readCompressed(offset + size, metadata.get("rawSize"))
+            self._dstream = BufferStream(self._record)
+        else:
+            self._record = None
+            self._dstream = self._fstream
+        self._dstream.readQString()
+
+    def _readCompressed(self, end, rawSize):
+        """
+        Decompresses the blocks from the current position of the file up to
+        the end, in a single buffer the features are then read from
+        """
+        record = bytearray() if rawSize is None else bytearray(rawSize)
+        pos = 0
+        while self._file.pos() < end:
+            header = self._fstream.readRawData(_BLOCK_HEADER.size)
+            if len(header) != _BLOCK_HEADER.size:
+                raise ValueError(self._filename + " is corrupted")
+            blockSize, compressedSize, crc = _BLOCK_HEADER.unpack(header)
+            raw = _decompressBlock(
+                self._fstream.readRawData(compressedSize),
+                blockSize,
+                crc,
+                self._filename,
+            )
+            if rawSize is None:
+                record += raw
+            elif pos + blockSize > rawSize:
+                raise ValueError(self._filename + " is corrupted")
+            else:
+                record[pos: pos + blockSize] = raw
+            pos += blockSize
+        if pos != len(record):
+            raise ValueError(self._filename + " is corrupted")
+        return record
+
     def readLayers(self, layers):
         if not self._dstream:
             raise ValueError("Layer stream not open for reading")
+
+        if self._directory is not None:
+            # go straight to the layers
+            for layer in layers:
+                if layer.id() in self._directory:
+                    self._seekRecord(layer.id())
+                    self.readLayer(layer)
+            return
+
         ds = self._dstream
 
         while True:
@@ -156,11 +660,31 @@ class Reader(QObject):
             else:
                 self.readLayer(layer)
 
+    def readLayerSchema(self, layer):
+        """Reads only the fields and subset string of a layer in the directory"""
+        if not self.hasPlainSchema(layer.id()):
+            raise ValueError("The schema of layer " + layer.id() + " is compressed")
+        self._seekRecord(layer.id())
+        ss, attr = self.readSchema(layer)
+        layer.setSubsetString(ss)
+        layer.updateFields()
+
     def readLayer(self, layer):
+        ss, attr = self.readSchema(layer)
+        dp = layer.dataProvider()
+        if self._version > 2:
+            self.readFeatures(dp, attr)
+        else:
+            self.readFeatureRecords(dp, attr)
+        layer.setSubsetString(ss)
+        layer.updateFields()
+        layer.updateExtents()
+
+    def readSchema(self, layer):
         ds = self._dstream
         dp = layer.dataProvider()
         if dp.featureCount() > 0:
-            raise ValueError("Memory layer " + id + " is already loaded")
+            raise ValueError("Memory layer " + layer.id() + " is already loaded")
         attr = dp.attributeIndexes()
         dp.deleteAttributes(attr)
         ss = ""
@@ -177,9 +701,122 @@ class Reader(QObject):
             comment = ds.readQString()
             fld = QgsField(name, qtype, typename, length, precision, comment)
             dp.addAttributes([fld])
+        return ss, attr
+
+    def readFeatures(self, dp, attr):
+        """
+        Reads the features of a record from a buffer, so neither the
+        attributes nor the WKB are copied in Python bytes first: compressed
+        features (the default) are read from the buffer they are decompressed
+        in, uncompressed ones from a memory map of the file, which also saves
+        the decompression.
+        """
+        if self._record is not None:
+            self.readBufferFeatures(dp, attr, self._record, self._dstream.pos())
+            # the decompressed record is not needed anymore
+            self._record = None
+            self._dstream = self._fstream
+            return
+        if self._entry is not None and self._entry[2].get("compression") == "zlib":
+            offset, size, metadata = self._entry
+            features = self._readCompressed(offset + size, metadata.get("rawSize"))
+            self.readBufferFeatures(dp, attr, features, 0)
+            return
+        mm = self._mapFile()
+        if mm is None:
+            self.readStreamFeatures(dp, attr)
+            return
+        try:
+            end = self.readBufferFeatures(dp, attr, mm, self._file.pos())
+        finally:
+            mm.close()
+        self._file.seek(end)
+
+    def _mapFile(self):
+        try:
+            with open(self._filename, "rb") as f:
+                # the map stays valid once the file is closed
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
 
+    def readBufferFeatures(self, dp, attr, buffer, offset):
+        """
+        Reads the features of a record from a buffer, starting at the offset
+        of the feature count, and returns the offset of the end of the record
+        """
+        with memoryview(buffer) as view:
+            # QDataStream integers are big endian
+            count, size = struct.unpack_from(">IQ", view, offset)
+            offset += 12
+            columns = QDataStream(_qbytes(view[offset: offset + size]))
+            columns.setVersion(QDataStream.Qt_4_5)
+            values = [[columns.readQVariant() for j in range(count)] for i in attr]
+            offset += size
+            sizes = _uint32Array(view[offset: offset + 4 * count])
+            offset += 4 * count
+            (size,) = struct.unpack_from(">Q", view, offset)
+            offset += 8
+            end = offset + size
+
+            nullgeom = QgsGeometry()
+            fields = dp.fields()
+            feats = []
+            for j in range(count):
+                feat = QgsFeature(fields)
+                feat.setAttributes([column[j] for column in values])
+                size = sizes[j]
+                if size == 0:
+                    feat.setGeometry(nullgeom)
+                else:
+                    geom = QgsGeometry()
+                    geom.fromWkb(_qbytes(view[offset: offset + size]))
+                    feat.setGeometry(geom)
+                    offset += size
+                feats.append(feat)
+                if len(feats) == READ_BATCH_SIZE:
+                    dp.addFeatures(feats)
+                    feats = []
+            if feats:
+                dp.addFeatures(feats)
+        return end
+
+    def readStreamFeatures(self, dp, attr):
+        ds = self._dstream
+        count = ds.readUInt32()
+        columns = QDataStream(QByteArray(ds.readRawData(ds.readUInt64())))
+        columns.setVersion(QDataStream.Qt_4_5)
+        values = [[columns.readQVariant() for j in range(count)] for i in attr]
+        sizes = _uint32Array(ds.readRawData(4 * count))
+        blob = ds.readRawData(ds.readUInt64())
+
+        nullgeom = QgsGeometry()
+        fields = dp.fields()
+        feats = []
+        offset = 0
+        for j in range(count):
+            feat = QgsFeature(fields)
+            feat.setAttributes([column[j] for column in values])
+            size = sizes[j]
+            if size == 0:
+                feat.setGeometry(nullgeom)
+            else:
+                geom = QgsGeometry()
+                geom.fromWkb(blob[offset: offset + size])
+                feat.setGeometry(geom)
+                offset += size
+            feats.append(feat)
+            if len(feats) == READ_BATCH_SIZE:
+                dp.addFeatures(feats)
+                feats = []
+        if feats:
+            dp.addFeatures(feats)
+
+    def readFeatureRecords(self, dp, attr):
+        ds = self._dstream
         nullgeom = QgsGeometry()
         fields = dp.fields()
+        feats = []
         while ds.readBool():
             feat = QgsFeature(fields)
             for i in attr:
@@ -194,13 +831,17 @@ class Reader(QObject):
                 geom = QgsGeometry()
                 geom.fromWkb(ds.readRawData(wkbSize))
                 feat.setGeometry(geom)
-            dp.addFeatures([feat])
-        layer.setSubsetString(ss)
-        layer.updateFields()
-        layer.updateExtents()
+            feats.append(feat)
+            if len(feats) == READ_BATCH_SIZE:
+                dp.addFeatures(feats)
+                feats = []
+        if feats:
+            dp.addFeatures(feats)
 
     def skipLayer(self):
         ds = self._dstream
+        if self._version > 1:
+            ds.readQString()
         nattr = ds.readInt16()
         attr = list(range(nattr))
         for i in attr:
@@ -210,6 +851,12 @@ class Reader(QObject):
             length = ds.readInt16()  # noqa: F841
             precision = ds.readInt16()  # noqa: F841
             comment = ds.readQString()  # noqa: F841
+        if self._version > 2:
+            count = ds.readUInt32()
+            ds.skipRawData(ds.readUInt64())
+            ds.skipRawData(4 * count)
+            ds.skipRawData(ds.readUInt64())
+            return
         while ds.readBool():
             for i in attr:
                 ds.readQVariant()
@@ -218,11 +865,45 @@ class Reader(QObject):
                 ds.readRawData(wkbSize)
 
 
+def ensureLayerLoaded(layer):
+    """
+    Reads the features of a memory layer restored without them (see lazy
+    loading), to be called before reading the features of a layer
+    """
+    if _saver is not None:
+        _saver.ensureLoaded(layer)
+
+
 class MemoryLayerSaver:
     def __init__(self, iface):
+        global _saver
+        _saver = self
         self._iface = iface
         version = Qgis.QGIS_VERSION_INT
         self._deleteSignalOk = version >= 10700
+        # Layers changed since they were last read or written: only those
+        # are encoded again on save, the records of the others are kept in
+        # or copied from the previous file
+        self._dirtyLayerIds = set()
+        # Subset strings and fields of the layers when they were last read
+        # or written
+        self._savedSubsetStrings = {}
+        self._savedSchemas = {}
+        # slots marking a layer dirty, by layer id, and whether the layers
+        # are being read or snapshot (which does not make them dirty)
+        self._dirtySlots = {}
+        self._ignoreChanges = False
+        # Thread writing the file of the last save
+        self._saveThread = None
+        # Layers registered with their schema and extent only, their
+        # features are read from _pendingFile when they are first needed
+        self._pendingLayerIds = set()
+        self._pendingFile = None
+        # reads the pending layers one by one when the application is idle,
+        # so they are all loaded shortly after the project is read
+        self._loadTimer = QTimer()
+        self._loadTimer.setInterval(0)
+        self._loadTimer.timeout.connect(self.loadNextPendingLayer)
 
     def attachToProject(self):
         self.connectToProject()
@@ -233,6 +914,8 @@ class MemoryLayerSaver:
         # Cannot delete memory files in Qgis 1.6 as they get deleted
         # on project exit.
         # self.deleteMemoryDataFiles()
+        self.waitForSave()
+        self._loadTimer.stop()
         self.disconnectFromProject()
         self.disconnectMemoryLayers()
         pass
@@ -242,6 +925,11 @@ class MemoryLayerSaver:
         proj.readProject.connect(self.loadData)
         proj.writeProject.connect(self.saveData)
         QgsProject.instance().layerWasAdded[QgsMapLayer].connect(self.connectProvider)
+        proj.layersWillBeRemoved.connect(self.forgetPendingLayers)
+        # before the render jobs are prepared, so the layers are drawn
+        self._iface.mapCanvas().layersChanged.connect(self.loadVisibleLayers)
+        self._iface.mapCanvas().extentsChanged.connect(self.loadVisibleLayers)
+        self._iface.currentLayerChanged.connect(self.ensureLoaded)
 
     def disconnectFromProject(self):
         proj = QgsProject.instance()
@@ -250,6 +938,10 @@ class MemoryLayerSaver:
         QgsProject.instance().layerWasAdded[QgsMapLayer].disconnect(
             self.connectProvider
         )
+        proj.layersWillBeRemoved.disconnect(self.forgetPendingLayers)
+        self._iface.mapCanvas().layersChanged.disconnect(self.loadVisibleLayers)
+        self._iface.mapCanvas().extentsChanged.disconnect(self.loadVisibleLayers)
+        self._iface.currentLayerChanged.disconnect(self.ensureLoaded)
 
     def connectProvider(self, layer):
         if self.isSavedLayer(layer):
@@ -260,6 +952,13 @@ class MemoryLayerSaver:
             layer.committedFeaturesAdded.connect(self.setProjectDirty2)
             layer.committedAttributeValuesChanges.connect(self.setProjectDirty2)
             layer.committedGeometriesChanges.connect(self.setProjectDirty2)
+            # changes done without the edit buffer, when they are signaled
+            slot = partial(self.setLayerDirty, layer.id())
+            self._dirtySlots[layer.id()] = slot
+            layer.dataChanged.connect(slot)
+            layer.attributeAdded.connect(slot)
+            layer.attributeDeleted.connect(slot)
+            layer.dataProvider().dataChanged.connect(slot)
 
     def disconnectProvider(self, layer):
         if self.isSavedLayer(layer):
@@ -270,6 +969,12 @@ class MemoryLayerSaver:
             layer.committedFeaturesAdded.disconnect(self.setProjectDirty2)
             layer.committedAttributeValuesChanges.disconnect(self.setProjectDirty2)
             layer.committedGeometriesChanges.disconnect(self.setProjectDirty2)
+            slot = self._dirtySlots.pop(layer.id(), None)
+            if slot is not None:
+                layer.dataChanged.disconnect(slot)
+                layer.attributeAdded.disconnect(slot)
+                layer.attributeDeleted.disconnect(slot)
+                layer.dataProvider().dataChanged.disconnect(slot)
 
     def connectMemoryLayers(self):
         for layer in self.memoryLayers():
@@ -284,34 +989,159 @@ class MemoryLayerSaver:
         pass
 
     def loadData(self):
+        self.waitForSave()
+        self._dirtyLayerIds = set()
+        self._savedSubsetStrings = {}
+        self._savedSchemas = {}
+        self._pendingLayerIds = set()
+        self._pendingFile = None
         filename = self.memoryLayerFile()
         file = QFile(filename)
         if file.exists():
             layers = list(self.memoryLayers())
             if layers:
+                self._ignoreChanges = True
                 try:
                     with Reader(filename) as reader:
-                        reader.readLayers(layers)
+                        lazyLayers = []
+                        if self.lazyLoading() and reader.hasDirectory():
+                            lazyLayers = [
+                                layer
+                                for layer in layers
+                                if "extent"
+                                in (reader.layerMetadata(layer.id()) or {})
+                                and reader.hasPlainSchema(layer.id())
+                            ]
+                        reader.readLayers(
+                            [layer for layer in layers if layer not in lazyLayers]
+                        )
+                        for layer in lazyLayers:
+                            reader.readLayerSchema(layer)
+                            extent = reader.layerMetadata(layer.id())["extent"]
+                            layer.setExtent(QgsRectangle(*extent))
+                            self._pendingLayerIds.add(layer.id())
+                    self._pendingFile = filename
+                    for layer in layers:
+                        self._savedSubsetStrings[layer.id()] = layer.subsetString()
+                        self._savedSchemas[layer.id()] = self.layerSchema(layer)
+                    if self._pendingLayerIds:
+                        self.loadVisibleLayers()
+                        self._loadTimer.start()
                 except:  # noqa: E722
                     QMessageBox.information(
                         self._iface.mainWindow(),
                         "Error reloading memory layers",
                         str(sys.exc_info()[1]),
                     )
+                finally:
+                    self._ignoreChanges = False
+
+    def lazyLoading(self):
+        return QgsSettings().value("/kadasrouting/mldata_lazy_loading", True, type=bool)
+
+    def compression(self):
+        return QgsSettings().value("/kadasrouting/mldata_compression", True, type=bool)
+
+    def ensureLoaded(self, layer):
+        """Reads the features of a layer registered without them, if needed"""
+        if layer is None or layer.id() not in self._pendingLayerIds:
+            return
+        self.waitForSave()
+        self._pendingLayerIds.discard(layer.id())
+        self._ignoreChanges = True
+        try:
+            with Reader(self._pendingFile) as reader:
+                reader.readLayers([layer])
+        except:  # noqa: E722
+            QMessageBox.information(
+                self._iface.mainWindow(),
+                "Error reloading memory layers",
+                str(sys.exc_info()[1]),
+            )
+        finally:
+            self._ignoreChanges = False
+        # the layer may have been drawn empty
+        layer.triggerRepaint()
+
+    def loadNextPendingLayer(self):
+        if not self._pendingLayerIds:
+            self._loadTimer.stop()
+            return
+        layerId = next(iter(self._pendingLayerIds))
+        layer = QgsProject.instance().mapLayer(layerId)
+        if layer is None:
+            self._pendingLayerIds.discard(layerId)
+        else:
+            self.ensureLoaded(layer)
+
+    def loadVisibleLayers(self):
+        """Reads the features of the layers of the canvas in its extent"""
+        if not self._pendingLayerIds:
+            return
+        settings = self._iface.mapCanvas().mapSettings()
+        for layer in settings.layers():
+            if layer.id() not in self._pendingLayerIds:
+                continue
+            try:
+                transform = QgsCoordinateTransform(
+                    layer.crs(), settings.destinationCrs(), QgsProject.instance()
+                )
+                visible = transform.transformBoundingBox(layer.extent()).intersects(
+                    settings.visibleExtent()
+                )
+            except QgsCsException:
+                visible = True
+            if visible:
+                self.ensureLoaded(layer)
+
+    def forgetPendingLayers(self, layerIds):
+        self._pendingLayerIds.difference_update(layerIds)
 
     def saveData(self):
+        """
+        Saves the memory layers. Only a snapshot of the changed layers is
+        taken here, the encoding and the writing of the file are done on a
+        worker thread, see writeData.
+        """
+        self.waitForSave()
         try:
             filename = self.memoryLayerFile()
-            try:
-                file = QFile(QFileInfo(filename).filePath())
-                if file.exists():
-                    file.remove()
-            except:  # noqa: E722
-                pass
             layers = list(self.memoryLayers())
-            if layers:
-                with Writer(filename) as writer:
-                    writer.writeLayers(layers)
+            cleanIds = set()
+            previous = self.openPreviousData(filename)
+            if previous is not None:
+                try:
+                    cleanIds = set(
+                        layer.id()
+                        for layer in layers
+                        if self.isCleanLayer(layer, previous)
+                    )
+                    if len(cleanIds) == len(layers) and cleanIds == previous.layerIds():
+                        # nothing changed since the file was written
+                        return
+                finally:
+                    previous.close()
+            for layer in layers:
+                if layer.id() not in cleanIds:
+                    # e.g. saved under another name, its record can not be copied
+                    self.ensureLoaded(layer)
+            self._ignoreChanges = True
+            try:
+                items = [
+                    layer.id() if layer.id() in cleanIds else LayerSnapshot(layer)
+                    for layer in layers
+                ]
+            finally:
+                self._ignoreChanges = False
+            self._dirtyLayerIds = set()
+            self._savedSubsetStrings = {
+                layer.id(): layer.subsetString() for layer in layers
+            }
+            self._savedSchemas = {layer.id(): self.layerSchema(layer) for layer in layers}
+            self._saveThread = threading.Thread(
+                target=self.writeData, args=(filename, items, self.compression())
+            )
+            self._saveThread.start()
         except:  # noqa: E722
             raise
             QMessageBox.information(
@@ -320,6 +1150,132 @@ class MemoryLayerSaver:
                 str(sys.exc_info()[1]),
             )
 
+    def writeData(self, filename, items, compress=False):
+        """
+        Writes the memory layers file, run on the worker thread. The changed
+        layers are appended to the previous file if most of it is kept (see
+        canAppend), otherwise a new file replaces it.
+
+        :param items: for each layer, its snapshot or, for the layers that
+            did not change, its id, to keep or copy its record from the
+            previous file
+
+        :param compress: whether the records of the snapshots are compressed
+        """
+        tmpname = filename + ".tmp"
+        try:
+            if items:
+                previous = None
+                if any(not isinstance(item, LayerSnapshot) for item in items):
+                    previous = self.openPreviousData(filename)
+                append = previous is not None and self.canAppend(previous, items)
+                try:
+                    if append:
+                        entries = {
+                            item: previous.layerEntry(item)
+                            for item in items
+                            if not isinstance(item, LayerSnapshot)
+                        }
+                        previous.close()
+                        previous = None
+                    with Writer(
+                        filename if append else tmpname, compress, append
+                    ) as writer:
+                        for item in items:
+                            if isinstance(item, LayerSnapshot):
+                                writer.writeSnapshot(item)
+                            elif append:
+                                writer.keepLayer(item, *entries[item])
+                            else:
+                                writer.copyLayer(item, previous)
+                finally:
+                    if previous is not None:
+                        previous.close()
+                writer.verify()
+                if not append:
+                    # atomic, a reader sees either the previous file or the new one
+                    os.replace(tmpname, filename)
+            elif os.path.exists(filename):
+                os.remove(filename)
+        except Exception as e:
+            LOG.error("Error saving memory layers: %s" % e, exc_info=True)
+            # QgsMessageLog can be used from any thread
+            QgsMessageLog.logMessage(
+                "Error saving memory layers: %s" % e, "kadasrouting", Qgis.Critical
+            )
+            # the layers have to be written again on the next save, including
+            # the ones kept, in case the file was appended to
+            self._dirtyLayerIds.update(
+                item.id if isinstance(item, LayerSnapshot) else item for item in items
+            )
+            try:
+                os.remove(tmpname)
+            except OSError:
+                pass
+
+    def canAppend(self, previous, items):
+        """
+        Whether the changed layers can be appended to the previous file: only
+        if the records kept take at least APPEND_MIN_USED_RATIO of it, so the
+        records of removed or changed layers do not pile up
+        """
+        kept = sum(
+            previous.layerEntry(item)[1]
+            for item in items
+            if not isinstance(item, LayerSnapshot)
+        )
+        return kept >= APPEND_MIN_USED_RATIO * previous.size()
+
+    def waitForSave(self):
+        if self._saveThread is not None:
+            self._saveThread.join()
+            self._saveThread = None
+
+    def openPreviousData(self, filename):
+        """
+        Returns a reader on the file written by the last save, if its layers
+        can be copied, or None
+        """
+        if not filename or not QFile(filename).exists():
+            return None
+        reader = Reader(filename)
+        try:
+            reader.open()
+        except ValueError:
+            reader.close()
+            return None
+        if not reader.hasDirectory() or reader.version() != FORMAT_VERSION:
+            # records of older versions are not copied, they are written again
+            reader.close()
+            return None
+        return reader
+
+    def isCleanLayer(self, layer, previous):
+        """Whether the record of a layer in the previous file is still up to date"""
+        metadata = previous.layerMetadata(layer.id())
+        if metadata is None or layer.id() in self._dirtyLayerIds:
+            return False
+        if layer.id() in self._pendingLayerIds:
+            # not read yet, so not changed
+            return self._pendingFile == previous.filename()
+        if self._savedSubsetStrings.get(layer.id()) != layer.subsetString():
+            return False
+        if layer.subsetString():
+            # the feature count of the provider is filtered, so it can not
+            # be checked: the layer is encoded again, to be safe
+            return False
+        if self._savedSchemas.get(layer.id()) != self.layerSchema(layer):
+            return False
+        # features added or removed directly in the provider may not emit
+        # any signal, so the feature count is checked as well
+        return metadata.get("featureCount") == layer.dataProvider().featureCount()
+
+    def layerSchema(self, layer):
+        return [
+            (fld.name(), int(fld.type()), fld.typeName(), fld.length(), fld.precision())
+            for fld in layer.dataProvider().fields()
+        ]
+
     def memoryLayers(self):
         for l in list(QgsProject.instance().mapLayers().values()):  # noqa: E741
             if self.isSavedLayer(l):
@@ -350,8 +1306,15 @@ class MemoryLayerSaver:
         pl.deleteAttributes(pl.attributeIndexes())
 
     def setProjectDirty2(self, value1, value2):
+        # value1 is the id of the layer whose changes have been committed
+        self._dirtyLayerIds.add(value1)
         self.setProjectDirty()
 
+    def setLayerDirty(self, layerId, *args):
+        if not self._ignoreChanges:
+            self._dirtyLayerIds.add(layerId)
+            self.setProjectDirty()
+
     def setProjectDirty(self):
         QgsProject.instance().setDirty(True)
 
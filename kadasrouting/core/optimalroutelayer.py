@@ -5,7 +5,9 @@ import datetime
 
 from PyQt5.QtCore import QTimer, pyqtSignal, Qt
 from PyQt5.QtGui import QColor, QPen, QBrush
-from PyQt5.QtWidgets import QAction
+from PyQt5.QtWidgets import QAction, QFileDialog
+
+from qgis.utils import iface
 
 from kadas.kadasgui import KadasPinItem, KadasItemPos, KadasItemLayer, KadasGpxRouteItem
 
@@ -13,11 +15,21 @@ from kadasrouting.utilities import (
     iconPath,
     waitcursor,
     pushWarning,
-    decodePolyline6,
+    pushMessage,
     formatdist,
 )
 
 from kadasrouting.valhalla.client import ValhallaClient
+from kadasrouting.core.routemodel import (
+    Route,
+    RouteLeg,
+    RouteTracker,
+    ellipsoidalDistanceArea,
+    measureMeters,
+    encodeRoute,
+    decodeRoute,
+)
+from kadasrouting.core.routeexport import exportRoutesToGeoPackage
 
 from qgis.core import (
     QgsProject,
@@ -26,7 +38,6 @@ from qgis.core import (
     QgsPointXY,
     QgsGeometry,
     QgsFeature,
-    QgsDistanceArea,
     QgsUnitTypes,
 )
 
@@ -38,6 +49,14 @@ LOG = logging.getLogger(__name__)
 
 MAX_DISTANCE_FOR_NAVIGATION = 30
 
+# Douglas-Peucker tolerances (in degrees) of the simplified versions of the
+# route line, used when the map pixel is larger than the tolerance
+ROUTE_LOD_TOLERANCES = [0.00002, 0.0001, 0.0005, 0.0025, 0.01]
+
+# Line color: 005EFF, width in pixels
+ROUTE_LINE_COLOR = QColor(0, 94, 255)
+ROUTE_LINE_WIDTH = 5
+
 _icon_for_maneuver = {
     1: "direction_depart",
     2: "direction_depart_right",
@@ -98,6 +117,57 @@ class RoutePointMapItem(KadasPinItem):
         self.hasChanged.emit()
 
 
+class RouteLineItem(KadasGpxRouteItem):
+    """
+    Route line item holding the full resolution geometry, used for its
+    extent, picking, tooltip and export, but drawn with the coarsest
+    simplified geometry whose tolerance is below the size of a pixel at the
+    scale of each render context.
+    """
+
+    def __init__(self, geom, lodGeometries):
+        KadasGpxRouteItem.__init__(self)
+        self.addPartFromGeometry(geom.constGet())
+        self.geom = geom
+        self.lodGeometries = lodGeometries
+        self.setOutline(QPen(ROUTE_LINE_COLOR, ROUTE_LINE_WIDTH))
+        self.setFill(QBrush(ROUTE_LINE_COLOR, Qt.SolidPattern))
+
+    def geometryForContext(self, context):
+        transform = context.coordinateTransform()
+        if transform.isValid():
+            crs = transform.destinationCrs()
+        else:
+            crs = QgsCoordinateReferenceSystem("EPSG:4326")
+        degreesPerPixel = context.mapToPixel().mapUnitsPerPixel() * (
+            QgsUnitTypes.fromUnitToUnitFactor(
+                crs.mapUnits(), QgsUnitTypes.DistanceDegrees
+            )
+        )
+        level = None
+        for i, (tolerance, _) in enumerate(self.lodGeometries):
+            if tolerance <= degreesPerPixel:
+                level = i
+        return self.geom if level is None else self.lodGeometries[level][1]
+
+    def render(self, context):
+        if context.renderingStopped():
+            return
+        geom = QgsGeometry(self.geometryForContext(context))
+        transform = context.coordinateTransform()
+        if transform.isValid():
+            geom.transform(transform)
+        geom.mapToPixel(context.mapToPixel())
+        width = context.convertToPainterUnits(
+            ROUTE_LINE_WIDTH, QgsUnitTypes.RenderPixels
+        )
+        painter = context.painter()
+        painter.save()
+        painter.setPen(QPen(ROUTE_LINE_COLOR, width))
+        painter.drawPolyline(geom.asQPolygonF())
+        painter.restore()
+
+
 class OptimalRouteLayer(KadasItemLayer):
 
     LAYER_TYPE = "optimalroute"
@@ -110,12 +180,18 @@ class OptimalRouteLayer(KadasItemLayer):
             OptimalRouteLayer.LAYER_TYPE,
         )
         self.geom = None
-        self.response = None
+        self.route = None
+        self.tracker = None
+        # route read from a project and not built yet, as (attribute, value)
+        self._pendingRoute = None
         self.points = []
         self.pins = []
         self.profile = None
         self.costingOptions = {}
-        self.lineItem = None
+        self.avoidPolygons = None
+        self.patrolPolygons = None
+        self.legCache = {}
+        self.lodGeometries = []
         self.valhalla = ValhallaClient.getInstance()
         self.timer = QTimer()
         self.timer.setSingleShot(True)
@@ -124,19 +200,42 @@ class OptimalRouteLayer(KadasItemLayer):
             self.tr("Add to project as regular layer")
         )
         self.actionAddAsRegularLayer.triggered.connect(self.addAsRegularLayer)
-
-    def setResponse(self, response):
-        self.response = response
+        self.actionExportToGeoPackage = QAction(
+            self.tr("Export routes to GeoPackage...")
+        )
+        self.actionExportToGeoPackage.triggered.connect(self.exportToGeoPackage)
 
     def clear(self):
         items = self.items()
         for itemId in items.keys():
             self.takeItem(itemId)
         self.pins = []
-        self.maneuvers = {}
 
     def hasRoute(self):
-        return self.geom is not None
+        return self.geom is not None or self._pendingRoute is not None
+
+    def ensureRoute(self):
+        """
+        Builds the route read from the project, which is only done the first
+        time the layer is rendered or its route is used.
+        """
+        if self._pendingRoute is None:
+            return
+        attribute, value = self._pendingRoute
+        self._pendingRoute = None
+        if attribute == "route":
+            response = decodeRoute(value)
+        else:
+            response = json.loads(value)
+        self.computeFromResponse(response)
+
+    def createMapRenderer(self, context):
+        self.ensureRoute()
+        return KadasItemLayer.createMapRenderer(self, context)
+
+    def extent(self):
+        self.ensureRoute()
+        return KadasItemLayer.extent(self)
 
     def pinHasChanged(self):
         self.timer.start(1000)
@@ -144,12 +243,21 @@ class OptimalRouteLayer(KadasItemLayer):
     @waitcursor
     def updateFromPins(self):
         try:
-            for i, pin in enumerate(self.pins):
-                self.points[i] = QgsPointXY(pin.position())
-            response = self.valhalla.route(
-                self.points, self.profile, self.costingOptions
-            )
-            self.computeFromResponse(response)
+            points = [QgsPointXY(pin.position()) for pin in self.pins]
+            if self.patrolPolygons or len(self.route.legs) != len(points) - 1:
+                response = self.valhalla.route(
+                    points,
+                    self.profile,
+                    self.avoidPolygons,
+                    self.costingOptions,
+                    self.patrolPolygons,
+                )
+                self.points = points
+                self.computeFromResponse(response)
+            else:
+                legs = self.legsFromPoints(points)
+                self.points = points
+                self.setLegs(legs)
             self.triggerRepaint()
         except Exception as e:
             logging.error(e, exc_info=True)
@@ -157,6 +265,45 @@ class OptimalRouteLayer(KadasItemLayer):
             pushWarning(self.tr("Could not compute route"))
             logging.error("Could not compute route")
 
+    @staticmethod
+    def _legKey(pt1, pt2):
+        return (
+            round(pt1.x(), 6),
+            round(pt1.y(), 6),
+            round(pt2.x(), 6),
+            round(pt2.y(), 6),
+        )
+
+    def legsFromPoints(self, points):
+        """
+        Returns the legs of a route through the given points, reusing the
+        cached legs between points that have not moved. Only the missing legs
+        are computed, consecutive ones with a single call to the engine, and
+        they are stitched with the cached ones.
+        """
+        legs = [
+            self.legCache.get(self._legKey(pt1, pt2))
+            for pt1, pt2 in zip(points, points[1:])
+        ]
+        qgsdistance = ellipsoidalDistanceArea()
+        i = 0
+        while i < len(legs):
+            if legs[i] is not None:
+                i += 1
+                continue
+            j = i
+            while j < len(legs) and legs[j] is None:
+                j += 1
+            response = self.valhalla.route(
+                points[i: j + 1], self.profile, self.avoidPolygons, self.costingOptions
+            )
+            legs[i:j] = [
+                RouteLeg.fromResponseLeg(leg, qgsdistance)
+                for leg in response["trip"]["legs"]
+            ]
+            i = j
+        return legs
+
     @waitcursor
     def updateFromPolyline(self, polyline, profile, costingOptions):
         try:
@@ -176,39 +323,73 @@ class OptimalRouteLayer(KadasItemLayer):
             )
             self.costingOptions = costingOptions
             self.profile = profile
+            self.avoidPolygons = avoid_polygons
+            self.patrolPolygons = patrol_polygons
             self.points = points
+            self.legCache = {}
             self.computeFromResponse(response)
             self.triggerRepaint()
         except ValhallaException as e:
             pushWarning(str(e))
             LOG.error(e)
 
+    def canReroute(self):
+        # routes computed from a polyline have no route points, and a patrol
+        # can not be recomputed from an arbitrary position
+        return len(self.points) > 1 and not self.patrolPolygons
+
+    def reroutePoints(self, point):
+        """
+        Returns the points for a new route from the given point to the
+        waypoints and destination not reached yet.
+        """
+        lastLegIndex = self.tracker.lastLegIndex or 0
+        return [point] + self.points[lastLegIndex + 1:]
+
+    def applyReroute(self, points, legs, preparedRoute):
+        """Replaces the route with one built by a RerouteTask"""
+        self.points = points
+        self.setLegs(legs, preparedRoute)
+        self.triggerRepaint()
+
+    def legsByShape(self):
+        """The legs of the route, by shape, so unchanged legs can be reused"""
+        return {leg.shape: leg for leg in self.route.legs} if self.route else {}
+
     def computeFromResponse(self, response):
         if response is None:
             return
+        # the response itself is not kept, only the route built from it
+        self.setLegs(
+            legsFromResponse(response, self.legsByShape(), ellipsoidalDistanceArea())
+        )
+
+    def setLegs(self, legs, preparedRoute=None):
+        """
+        Sets the legs of the route. The route and its geometries are built
+        from the legs unless they are given, as returned by prepareRoute.
+        """
         epsg4326 = QgsCoordinateReferenceSystem("EPSG:4326")
+        self._pendingRoute = None
         self.clear()
-        self.response = response
-        response_mini = response["trip"]
-        coordinates = []
         self.duration = 0
         self.distance = 0
-        for leg in response_mini["legs"]:
-            leg_coordinates = [
-                list(reversed(coord)) for coord in decodePolyline6(leg["shape"])
-            ]
-            coordinates.extend(leg_coordinates)
-            qgis_leg_coords = [QgsPointXY(x, y) for x, y in leg_coordinates]
-            geom = QgsGeometry.fromPolylineXY(qgis_leg_coords)
-            self.maneuvers[geom] = leg["maneuvers"]
-            self.duration += leg["summary"]["time"]
-            self.distance += round(leg["summary"]["length"], 3)
-        qgis_coords = [QgsPointXY(x, y) for x, y in coordinates]
-        self.geom = QgsGeometry.fromPolylineXY(qgis_coords)
-        self.lineItem = KadasGpxRouteItem()
-        self.lineItem.addPartFromGeometry(self.geom.constGet())
-        self.lineItem.setName("route")
-        self.lineItem.setNumber("1")
+        for leg in legs:
+            self.duration += leg.time
+            self.distance += round(leg.length, 3)
+        if preparedRoute is None:
+            preparedRoute = prepareRoute(legs)
+        self.route, self.geom, self.lodGeometries = preparedRoute
+        self.tracker = RouteTracker(self.route)
+        # only the legs of the current route are kept, so the cache does not
+        # grow with each move of a route point
+        if not self.patrolPolygons and len(legs) == len(self.points) - 1:
+            self.legCache = {
+                self._legKey(pt1, pt2): leg
+                for pt1, pt2, leg in zip(self.points, self.points[1:], legs)
+            }
+        else:
+            self.legCache = {}
         # Format string for duration
         duration_hour = int(self.duration) // 3600
         duration_minute = (int(self.duration) % 3600) // 60
@@ -225,13 +406,11 @@ class OptimalRouteLayer(KadasItemLayer):
             formatted_hour=formatted_hour,
             formatted_minute=formatted_minute,
         )
-        self.lineItem.setTooltip(tooltip)
-        # Line color: 005EFF
-        line_color = QColor(0, 94, 255)
-        self.lineItem.setOutline(QPen(line_color, 5))
-        self.lineItem.setFill(QBrush(line_color, Qt.SolidPattern))
-
-        self.addItem(self.lineItem)
+        lineItem = RouteLineItem(self.geom, self.lodGeometries)
+        lineItem.setName("route")
+        lineItem.setNumber("1")
+        lineItem.setTooltip(tooltip)
+        self.addItem(lineItem)
         for i, pt in enumerate(self.points):
             pin = RoutePointMapItem(epsg4326)
             pin.setPosition(KadasItemPos(pt.x(), pt.y()))
@@ -251,66 +430,47 @@ class OptimalRouteLayer(KadasItemLayer):
             self.addItem(pin)
 
     def maneuverForPoint(self, pt, speed):
-        min_dist = MAX_DISTANCE_FOR_NAVIGATION
-        closest_leg = None
-        closest_segment = None
-        qgsdistance = QgsDistanceArea()
-        qgsdistance.setSourceCrs(
-            QgsCoordinateReferenceSystem(4326), QgsProject.instance().transformContext()
-        )
-        qgsdistance.setEllipsoid(qgsdistance.sourceCrs().ellipsoidAcronym())
-
-        legs = list(self.maneuvers.keys())
-        for i, line in enumerate(legs):
-            _, _pt, segment, _ = line.closestSegmentWithContext(pt)
-            dist = qgsdistance.convertLengthMeasurement(
-                qgsdistance.measureLine(pt, _pt), QgsUnitTypes.DistanceMeters
+        self.ensureRoute()
+        match = self.tracker.match(pt, MAX_DISTANCE_FOR_NAVIGATION)
+
+        if match is not None:
+            closest_leg = match.legIndex
+            closest_segment = match.segment
+            closest_point = match.point
+            leg = self.route.legs[closest_leg]
+            maneuvers = leg.maneuvers
+            # distance from the matched point to the next shape vertex, the rest
+            # is taken from the precomputed cumulative distances of the route
+            partial = measureMeters(
+                self.tracker.qgsdistance, closest_point, leg.point(closest_segment)
             )
-            if dist < min_dist:
-                closest_leg = line
-                closest_segment = segment
-                closest_point = _pt
-                min_dist = dist
-
-        if closest_leg is not None:
-            leg_points = closest_leg.asPolyline()
-            maneuvers = self.maneuvers[closest_leg]
-            for i, maneuver in enumerate(maneuvers[:-1]):
+            for i in range(len(maneuvers) - 1):
                 if (
-                    maneuver["begin_shape_index"] < closest_segment
-                    and maneuver["end_shape_index"] >= closest_segment
+                    maneuvers.beginShapeIndex(i) < closest_segment
+                    and maneuvers.endShapeIndex(i) >= closest_segment
                 ):
-                    points = [closest_point]
-                    points.extend(
-                        leg_points[closest_segment: maneuver["end_shape_index"]]
-                    )
-                    distance_to_next = qgsdistance.convertLengthMeasurement(
-                        qgsdistance.measureLine(points), QgsUnitTypes.DistanceMeters
+                    distance_to_next = (
+                        partial
+                        + leg.cumulativeDistance[maneuvers.endShapeIndex(i)]
+                        - leg.cumulativeDistance[closest_segment]
                     )
 
-                    message = maneuvers[i + 1]["instruction"]
+                    message = maneuvers.instruction(i + 1)
                     if i == len(maneuvers) - 2:
                         distance_to_next2 = None
                         message2 = ""
                         icon2 = _icon_path("transparentpixel")
                     else:
-                        next_maneuver = maneuvers[i + 2]
-                        distance_to_next2 = maneuvers[i + 1]["length"] * 1000
-                        message2 = next_maneuver["instruction"]
-                        icon2 = icon_path_for_maneuver(maneuvers[i + 2]["type"])
+                        distance_to_next2 = maneuvers.length(i + 1) * 1000
+                        message2 = maneuvers.instruction(i + 2)
+                        icon2 = icon_path_for_maneuver(maneuvers.type(i + 2))
 
-                    icon = icon_path_for_maneuver(maneuvers[i + 1]["type"])
+                    icon = icon_path_for_maneuver(maneuvers.type(i + 1))
 
                     time_to_next = distance_to_next / 1000 / speed * 3600
-                    try:
-                        maneuvers_ahead = maneuvers[i + 1:]
-                    except IndexError:
-                        maneuvers_ahead = []
-
-                    timeleft = time_to_next + sum([m["time"] for m in maneuvers_ahead])
-                    distanceleft = (
-                        distance_to_next
-                        + sum([m["length"] for m in maneuvers_ahead]) * 1000
+                    timeleft = time_to_next + self.route.timeLeft(closest_leg, i + 1)
+                    distanceleft = partial + self.route.distanceLeft(
+                        closest_leg, closest_segment
                     )
 
                     delta = datetime.timedelta(seconds=timeleft)
@@ -354,12 +514,17 @@ class OptimalRouteLayer(KadasItemLayer):
 
     def readXml(self, node, context):
         element = node.toElement()
-        response = json.loads(element.attribute("response"))
+        # projects saved with older versions store the full response
+        if element.hasAttribute("route"):
+            self._pendingRoute = ("route", element.attribute("route"))
+        elif element.attribute("response") not in ("", "null"):
+            self._pendingRoute = ("response", element.attribute("response"))
         points = json.loads(element.attribute("points"))
         self.points = [QgsGeometry.fromWkt(wkt).asPoint() for wkt in points]
         self.costingOptions = json.loads(element.attribute("costingOptions"))
         self.profile = element.attribute("profile")
-        self.computeFromResponse(response)
+        self.avoidPolygons = json.loads(element.attribute("avoidPolygons") or "null")
+        self.patrolPolygons = json.loads(element.attribute("patrolPolygons") or "null")
         return True
 
     def writeXml(self, node, doc, context):
@@ -368,13 +533,23 @@ class OptimalRouteLayer(KadasItemLayer):
         # write plugin layer type to project  (essential to be read from project)
         element.setAttribute("type", "plugin")
         element.setAttribute("name", self.layerTypeKey())
-        element.setAttribute("response", json.dumps(self.response))
+        if self._pendingRoute is not None:
+            attribute, value = self._pendingRoute
+            if attribute == "route":
+                element.setAttribute("route", value)
+            else:
+                element.setAttribute("route", encodeRoute(json.loads(value)))
+        elif self.route is not None:
+            element.setAttribute("route", encodeRoute(self.route.toResponse()))
         element.setAttribute("points", json.dumps([pt.asWkt() for pt in self.points]))
         element.setAttribute("profile", self.profile)
         element.setAttribute("costingOptions", json.dumps(self.costingOptions))
+        element.setAttribute("avoidPolygons", json.dumps(self.avoidPolygons))
+        element.setAttribute("patrolPolygons", json.dumps(self.patrolPolygons))
         return True
 
     def addAsRegularLayer(self):
+        self.ensureRoute()
         layer = QgsVectorLayer(
             "LineString?crs=epsg:4326&field=id:integer&field=distance:double&field=duration:double",
             self.name(),
@@ -388,6 +563,67 @@ class OptimalRouteLayer(KadasItemLayer):
         layer.updateExtents()
         QgsProject.instance().addMapLayer(layer)
 
+    def exportToGeoPackage(self):
+        """Exports this layer and the other selected route layers to a GeoPackage"""
+        layers = [
+            layer
+            for layer in iface.layerTreeView().selectedLayers()
+            if isinstance(layer, OptimalRouteLayer) and layer.id() != self.id()
+        ]
+        layers.insert(0, self)
+        filename, _ = QFileDialog.getSaveFileName(
+            iface.mainWindow(),
+            self.tr("Export routes to GeoPackage"),
+            "",
+            self.tr("GeoPackage (*.gpkg)"),
+        )
+        if not filename:
+            return
+        try:
+            count = waitcursor(exportRoutesToGeoPackage)(layers, filename)
+            pushMessage(
+                self.tr("{count} routes exported to {filename}").format(
+                    count=count, filename=filename
+                )
+            )
+        except Exception as e:
+            LOG.error(e, exc_info=True)
+            pushWarning(self.tr("Could not export routes: {error}").format(error=e))
+
+
+def legsFromResponse(response, previousLegs, qgsdistance):
+    """
+    Builds the legs of a route response, reusing the legs with the same
+    shape, which keep their precomputed tables. It can be run in a
+    background thread.
+    """
+    legs = []
+    for leg in response["trip"]["legs"]:
+        routeLeg = previousLegs.get(leg["shape"])
+        if routeLeg is None:
+            routeLeg = RouteLeg.fromResponseLeg(leg, qgsdistance)
+        legs.append(routeLeg)
+    return legs
+
+
+def prepareRoute(legs):
+    """
+    Builds the route made of the legs, its line and the simplified versions
+    of the line. It can be run in a background thread.
+
+    :returns: The route, its geometry and the (tolerance, geometry) pairs of
+        the simplified geometries
+    :rtype: (Route, QgsGeometry, list)
+    """
+    coordinates = []
+    for leg in legs:
+        coordinates.extend(leg.pointList())
+    geom = QgsGeometry.fromPolylineXY(coordinates)
+    lodGeometries = [
+        (tolerance, geom.simplify(tolerance)) for tolerance in ROUTE_LOD_TOLERANCES
+    ]
+    return Route(legs), geom, lodGeometries
+
 
 class OptimalRouteLayerType(KadasPluginLayerType):
     def __init__(self):
@@ -401,3 +637,4 @@ class OptimalRouteLayerType(KadasPluginLayerType):
 
     def addLayerTreeMenuActions(self, menu, layer):
         menu.addAction(layer.actionAddAsRegularLayer)
+        menu.addAction(layer.actionExportToGeoPackage)
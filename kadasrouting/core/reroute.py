@@ -0,0 +1,103 @@
+import time
+import logging
+
+from qgis.core import QgsTask
+
+from kadasrouting.utilities import tr
+from kadasrouting.valhalla.client import ValhallaClient
+from kadasrouting.core.routemodel import ellipsoidalDistanceArea, measureMeters
+from kadasrouting.core.optimalroutelayer import legsFromResponse, prepareRoute
+
+LOG = logging.getLogger(__name__)
+
+# The vehicle is considered off the route once it has not been matched on the
+# route for OFF_ROUTE_TIME_S seconds and it is at least OFF_ROUTE_DISTANCE
+# meters away from the last point where it was on the route
+OFF_ROUTE_DISTANCE = 50
+OFF_ROUTE_TIME_S = 5
+
+
+class OffRouteDetector:
+    """
+    Decides when a vehicle has really left the route, so a single bad GPS fix
+    or a short deviation does not trigger a new route computation.
+    """
+
+    def __init__(
+        self, distanceThreshold=OFF_ROUTE_DISTANCE, timeThreshold=OFF_ROUTE_TIME_S
+    ):
+        self.distanceThreshold = distanceThreshold
+        self.timeThreshold = timeThreshold
+        self.qgsdistance = ellipsoidalDistanceArea()
+        self.reset()
+
+    def reset(self):
+        self.lastPointOnRoute = None
+        self.offRouteSince = None
+
+    def onRoute(self, point):
+        self.lastPointOnRoute = point
+        self.offRouteSince = None
+
+    def offRoute(self, point):
+        """
+        Registers a position that could not be matched on the route, and
+        returns True if the vehicle has to be considered off the route.
+        """
+        now = time.monotonic()
+        if self.offRouteSince is None:
+            self.offRouteSince = now
+        if now - self.offRouteSince < self.timeThreshold:
+            return False
+        if self.lastPointOnRoute is None:
+            return True
+        distance = measureMeters(self.qgsdistance, point, self.lastPointOnRoute)
+        return distance >= self.distanceThreshold
+
+
+class RerouteTask(QgsTask):
+    """
+    Computes in the background a new route for an OptimalRouteLayer, from the
+    given points and with the profile, costing options and areas to avoid of
+    the layer. The legs and the route are also built in the background, the
+    route of the layer is only replaced with them from the main thread.
+    """
+
+    def __init__(self, layer, points):
+        QgsTask.__init__(self, tr("Computing new route"), QgsTask.CanCancel)
+        self.layer = layer
+        self.points = points
+        self.profile = layer.profile
+        self.avoidPolygons = layer.avoidPolygons
+        self.costingOptions = dict(layer.costingOptions)
+        self.previousLegs = layer.legsByShape()
+        # created here, as it reads the transform context of the project
+        self.qgsdistance = ellipsoidalDistanceArea()
+        self.legs = None
+        self.preparedRoute = None
+        self.exception = None
+
+    def run(self):
+        try:
+            response = ValhallaClient.getInstance().route(
+                self.points, self.profile, self.avoidPolygons, self.costingOptions
+            )
+            if self.isCanceled():
+                return False
+            self.legs = legsFromResponse(response, self.previousLegs, self.qgsdistance)
+            self.preparedRoute = prepareRoute(self.legs)
+        except Exception as e:
+            self.exception = e
+            return False
+        return not self.isCanceled()
+
+    def finished(self, result):
+        if not result:
+            if self.exception is not None:
+                LOG.error("Could not compute new route: %s" % self.exception)
+            return
+        try:
+            self.layer.applyReroute(self.points, self.legs, self.preparedRoute)
+        except RuntimeError as e:
+            # the layer has been removed in the meantime
+            LOG.debug(e)
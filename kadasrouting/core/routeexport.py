@@ -0,0 +1,191 @@
+import logging
+
+from PyQt5.QtCore import QVariant
+
+from qgis.core import (
+    QgsProject,
+    QgsVectorFileWriter,
+    QgsVectorLayer,
+    QgsWkbTypes,
+    QgsFields,
+    QgsField,
+    QgsFeature,
+    QgsGeometry,
+)
+
+from kadasrouting.utilities import tr
+
+LOG = logging.getLogger(__name__)
+
+LEGS_TABLE = "route_legs"
+MANEUVERS_TABLE = "route_maneuvers"
+POINTS_TABLE = "route_points"
+
+
+def _fields(definitions):
+    fields = QgsFields()
+    for name, qtype in definitions:
+        fields.append(QgsField(name, qtype))
+    return fields
+
+
+# Routes are identified by the id of their layer, as layer names can repeat
+LEGS_FIELDS = _fields(
+    [
+        ("route_id", QVariant.String),
+        ("route_name", QVariant.String),
+        ("leg", QVariant.Int),
+        ("distance", QVariant.Double),
+        ("duration", QVariant.Double),
+    ]
+)
+
+MANEUVERS_FIELDS = _fields(
+    [
+        ("route_id", QVariant.String),
+        ("leg", QVariant.Int),
+        ("maneuver", QVariant.Int),
+        ("type", QVariant.Int),
+        ("instruction", QVariant.String),
+        ("time", QVariant.Double),
+        ("length", QVariant.Double),
+    ]
+)
+
+POINTS_FIELDS = _fields(
+    [
+        ("route_id", QVariant.String),
+        ("point", QVariant.Int),
+        ("role", QVariant.String),
+    ]
+)
+
+
+def _legFeatures(layer):
+    for legIndex, leg in enumerate(layer.route.legs):
+        feature = QgsFeature(LEGS_FIELDS)
+        feature.setAttributes(
+            [layer.id(), layer.name(), legIndex, leg.length, leg.time]
+        )
+        feature.setGeometry(leg.geometry())
+        yield feature
+
+
+def _maneuverFeatures(layer):
+    for legIndex, leg in enumerate(layer.route.legs):
+        maneuvers = leg.maneuvers
+        for i in range(len(maneuvers)):
+            points = leg.pointList(
+                maneuvers.beginShapeIndex(i), maneuvers.endShapeIndex(i) + 1
+            )
+            if len(points) == 1:
+                # arrival maneuvers have a single shape point
+                points = points * 2
+            feature = QgsFeature(MANEUVERS_FIELDS)
+            feature.setAttributes(
+                [
+                    layer.id(),
+                    legIndex,
+                    i,
+                    maneuvers.type(i),
+                    maneuvers.instruction(i),
+                    maneuvers.time(i),
+                    maneuvers.length(i),
+                ]
+            )
+            feature.setGeometry(QgsGeometry.fromPolylineXY(points))
+            yield feature
+
+
+def _pointFeatures(layer):
+    for i, point in enumerate(layer.points):
+        if i == 0:
+            role = "origin"
+        elif i == len(layer.points) - 1:
+            role = "destination"
+        else:
+            role = "waypoint"
+        feature = QgsFeature(POINTS_FIELDS)
+        feature.setAttributes([layer.id(), i, role])
+        feature.setGeometry(QgsGeometry.fromPointXY(point))
+        yield feature
+
+
+def _writeTable(filename, tablename, fields, geometryType, features, overwriteFile):
+    # The features are written from a memory layer, as writeAsVectorFormatV2
+    # inserts them within a single transaction, unlike the writer returned
+    # by QgsVectorFileWriter.create(), which commits each feature
+    layer = QgsVectorLayer(
+        "{}?crs=epsg:4326".format(QgsWkbTypes.displayString(geometryType)),
+        tablename,
+        "memory",
+    )
+    pr = layer.dataProvider()
+    pr.addAttributes(fields.toList())
+    layer.updateFields()
+    if not pr.addFeatures(features):
+        raise Exception(
+            tr("Could not prepare table {tablename}").format(tablename=tablename)
+        )
+    options = QgsVectorFileWriter.SaveVectorOptions()
+    options.driverName = "GPKG"
+    options.layerName = tablename
+    options.fileEncoding = "UTF-8"
+    options.actionOnExistingFile = (
+        QgsVectorFileWriter.CreateOrOverwriteFile
+        if overwriteFile
+        else QgsVectorFileWriter.CreateOrOverwriteLayer
+    )
+    result = QgsVectorFileWriter.writeAsVectorFormatV2(
+        layer, filename, QgsProject.instance().transformContext(), options
+    )
+    # (error, message) and, from QGIS 3.20, the new filename and layer
+    if result[0] != QgsVectorFileWriter.NoError:
+        raise Exception(result[1])
+
+
+def exportRoutesToGeoPackage(layers, filename):
+    """
+    Exports route layers to a GeoPackage, with a table for the legs, one for
+    the maneuvers and one for the route points of all the routes.
+
+    :param layers: The route layers to export
+    :type layers: list of OptimalRouteLayer
+
+    :param filename: The GeoPackage file, overwritten if it exists
+    :type filename: str
+
+    :returns: The number of routes exported, layers without a route are
+        skipped
+    :rtype: int
+    """
+    legs = []
+    maneuvers = []
+    points = []
+    count = 0
+    for layer in layers:
+        layer.ensureRoute()
+        if not layer.hasRoute():
+            LOG.debug("layer %s has no route to export" % layer.name())
+            continue
+        legs.extend(_legFeatures(layer))
+        maneuvers.extend(_maneuverFeatures(layer))
+        points.extend(_pointFeatures(layer))
+        count += 1
+    if not legs:
+        raise Exception(tr("There are no routes to export"))
+    _writeTable(
+        filename, LEGS_TABLE, LEGS_FIELDS, QgsWkbTypes.LineString, legs, True
+    )
+    _writeTable(
+        filename,
+        MANEUVERS_TABLE,
+        MANEUVERS_FIELDS,
+        QgsWkbTypes.LineString,
+        maneuvers,
+        False,
+    )
+    _writeTable(
+        filename, POINTS_TABLE, POINTS_FIELDS, QgsWkbTypes.Point, points, False
+    )
+    return count
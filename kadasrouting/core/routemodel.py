@@ -0,0 +1,392 @@
+import sys
+import math
+import json
+from array import array
+import zlib
+import base64
+import logging
+
+from qgis.core import (
+    QgsProject,
+    QgsCoordinateReferenceSystem,
+    QgsPointXY,
+    QgsGeometry,
+    QgsDistanceArea,
+    QgsUnitTypes,
+    QgsRectangle,
+    QgsSpatialIndex,
+)
+
+from kadasrouting.utilities import decodePolyline6
+
+LOG = logging.getLogger(__name__)
+
+# Number of segments searched behind and ahead of the last matched segment
+# before falling back to a search over the whole route
+SEARCH_WINDOW_BEHIND = 2
+SEARCH_WINDOW_AHEAD = 50
+
+METERS_PER_DEGREE = 111320.0
+
+# Maneuver properties kept when a route is stored in a project
+MANEUVER_KEYS = (
+    "type",
+    "instruction",
+    "begin_shape_index",
+    "end_shape_index",
+    "time",
+    "length",
+)
+
+
+def ellipsoidalDistanceArea():
+    qgsdistance = QgsDistanceArea()
+    qgsdistance.setSourceCrs(
+        QgsCoordinateReferenceSystem(4326), QgsProject.instance().transformContext()
+    )
+    qgsdistance.setEllipsoid(qgsdistance.sourceCrs().ellipsoidAcronym())
+    return qgsdistance
+
+
+def measureMeters(qgsdistance, pt1, pt2):
+    return qgsdistance.convertLengthMeasurement(
+        qgsdistance.measureLine(pt1, pt2), QgsUnitTypes.DistanceMeters
+    )
+
+
+def compactResponse(response):
+    """
+    Returns a copy of a route response with only what is needed to rebuild
+    the route: the shape, summary and maneuvers of each leg and the summary
+    of the trip.
+    """
+    trip = response["trip"]
+    legs = []
+    for leg in trip["legs"]:
+        legs.append(
+            {
+                "shape": leg["shape"],
+                "summary": {
+                    "time": leg["summary"]["time"],
+                    "length": leg["summary"]["length"],
+                },
+                "maneuvers": [
+                    {k: m[k] for k in MANEUVER_KEYS if k in m}
+                    for m in leg["maneuvers"]
+                ],
+            }
+        )
+    return {
+        "trip": {
+            "legs": legs,
+            "summary": {
+                "time": trip["summary"]["time"],
+                "length": trip["summary"]["length"],
+            },
+        }
+    }
+
+
+def encodeRoute(response):
+    """Encodes a route response as a compressed string to store in a project"""
+    text = json.dumps(compactResponse(response), separators=(",", ":"))
+    return base64.b64encode(zlib.compress(text.encode("utf-8"), 9)).decode("ascii")
+
+
+def decodeRoute(encoded):
+    return json.loads(zlib.decompress(base64.b64decode(encoded)).decode("utf-8"))
+
+
+class Maneuvers:
+    """
+    The maneuvers of a route leg, stored as one array per property instead of
+    a dict per maneuver. Instructions are interned, so an instruction repeated
+    in many routes is stored once, and freed with the last route using it.
+    """
+
+    def __init__(self, maneuvers):
+        self._type = array("h", (m["type"] for m in maneuvers))
+        self._begin = array("l", (m["begin_shape_index"] for m in maneuvers))
+        self._end = array("l", (m["end_shape_index"] for m in maneuvers))
+        self._time = array("d", (m["time"] for m in maneuvers))
+        self._length = array("d", (m["length"] for m in maneuvers))
+        self._instruction = tuple(sys.intern(m["instruction"]) for m in maneuvers)
+
+    def __len__(self):
+        return len(self._type)
+
+    def type(self, i):
+        return self._type[i]
+
+    def beginShapeIndex(self, i):
+        return self._begin[i]
+
+    def endShapeIndex(self, i):
+        return self._end[i]
+
+    def time(self, i):
+        return self._time[i]
+
+    def length(self, i):
+        return self._length[i]
+
+    def instruction(self, i):
+        return self._instruction[i]
+
+    def asDict(self, i):
+        return {
+            "type": self.type(i),
+            "instruction": self.instruction(i),
+            "begin_shape_index": self.beginShapeIndex(i),
+            "end_shape_index": self.endShapeIndex(i),
+            "time": self.time(i),
+            "length": self.length(i),
+        }
+
+
+class RouteLeg:
+    """
+    A leg of a route (the part between two consecutive route points).
+
+    Besides the shape vertices and the maneuvers of the leg, it carries the
+    cumulative ellipsoidal distance (in meters) from the start of the leg
+    to each shape vertex, and the cumulative time (in seconds) from the
+    start of the leg to the beginning of each maneuver. The vertices are
+    stored as arrays of coordinates, points and geometries are built from
+    them when needed.
+    """
+
+    def __init__(self, shape, maneuvers, time, length, qgsdistance=None):
+        self.shape = shape
+        self.maneuvers = maneuvers
+        self.time = time
+        self.length = length
+        coordinates = decodePolyline6(shape)
+        self._x = array("d", (lon for lat, lon in coordinates))
+        self._y = array("d", (lat for lat, lon in coordinates))
+        qgsdistance = qgsdistance or ellipsoidalDistanceArea()
+        self.cumulativeDistance = array("d", [0.0])
+        points = self.pointList()
+        for pt1, pt2 in zip(points, points[1:]):
+            self.cumulativeDistance.append(
+                self.cumulativeDistance[-1] + measureMeters(qgsdistance, pt1, pt2)
+            )
+        self.cumulativeTime = array("d", [0.0])
+        for i in range(len(maneuvers)):
+            self.cumulativeTime.append(self.cumulativeTime[-1] + maneuvers.time(i))
+
+    @staticmethod
+    def fromResponseLeg(leg, qgsdistance=None):
+        return RouteLeg(
+            leg["shape"],
+            Maneuvers(leg["maneuvers"]),
+            leg["summary"]["time"],
+            leg["summary"]["length"],
+            qgsdistance,
+        )
+
+    def toResponseLeg(self):
+        return {
+            "shape": self.shape,
+            "summary": {"time": self.time, "length": self.length},
+            "maneuvers": [
+                self.maneuvers.asDict(i) for i in range(len(self.maneuvers))
+            ],
+        }
+
+    def pointCount(self):
+        return len(self._x)
+
+    def point(self, i):
+        return QgsPointXY(self._x[i], self._y[i])
+
+    def pointList(self, start=0, end=None):
+        """The shape vertices from start to end (excluded) as QgsPointXY"""
+        return [
+            QgsPointXY(x, y) for x, y in zip(self._x[start:end], self._y[start:end])
+        ]
+
+    def geometry(self):
+        return QgsGeometry.fromPolylineXY(self.pointList())
+
+    def totalDistance(self):
+        return self.cumulativeDistance[-1]
+
+    def totalTime(self):
+        return self.cumulativeTime[-1]
+
+
+class Route:
+    """
+    A route made of a list of legs, with the per-leg offsets needed to turn
+    the cumulative tables of each leg into route-wide values.
+    """
+
+    def __init__(self, legs):
+        self.legs = legs
+        self.distanceOffsets = []
+        self.timeOffsets = []
+        distance = 0.0
+        time = 0.0
+        for leg in legs:
+            self.distanceOffsets.append(distance)
+            self.timeOffsets.append(time)
+            distance += leg.totalDistance()
+            time += leg.totalTime()
+        self.totalDistance = distance
+        self.totalTime = time
+
+    def toResponse(self):
+        """Returns the route as a (compact) route response"""
+        return {
+            "trip": {
+                "legs": [leg.toResponseLeg() for leg in self.legs],
+                "summary": {
+                    "time": sum(leg.time for leg in self.legs),
+                    "length": sum(leg.length for leg in self.legs),
+                },
+            }
+        }
+
+    def distanceLeft(self, legIndex, vertexIndex):
+        """Distance in meters from a shape vertex to the end of the route"""
+        leg = self.legs[legIndex]
+        return self.totalDistance - (
+            self.distanceOffsets[legIndex] + leg.cumulativeDistance[vertexIndex]
+        )
+
+    def timeLeft(self, legIndex, maneuverIndex):
+        """Time in seconds from the beginning of a maneuver to the end of the route"""
+        leg = self.legs[legIndex]
+        return self.totalTime - (
+            self.timeOffsets[legIndex] + leg.cumulativeTime[maneuverIndex]
+        )
+
+
+class RouteMatch:
+    """
+    Position of a point matched on a route: the leg, the segment (index of the
+    shape vertex at the end of the segment, like
+    QgsGeometry.closestSegmentWithContext), the closest point on the route and
+    its distance in meters to the matched point.
+    """
+
+    def __init__(self, legIndex, segment, point, distance):
+        self.legIndex = legIndex
+        self.segment = segment
+        self.point = point
+        self.distance = distance
+
+
+class RouteTracker:
+    """
+    Matches successive positions of a vehicle on a route.
+
+    The segment matched last time is remembered and the next position is
+    first searched in a window of segments around it, mostly ahead of it.
+    Only when nothing is found close enough there (the vehicle seems to have
+    left the corridor) a search on the whole route is done, using a spatial
+    index of the route segments built the first time it is needed.
+    """
+
+    def __init__(self, route):
+        self.route = route
+        self.qgsdistance = ellipsoidalDistanceArea()
+        self.lastLegIndex = None
+        self.lastSegment = None
+        self._index = None
+        self._segments = None
+
+    def reset(self):
+        self.lastLegIndex = None
+        self.lastSegment = None
+
+    def match(self, pt, maxDistance):
+        """
+        Returns the RouteMatch for the given point, or None if the point is
+        farther than maxDistance meters from the route.
+        """
+        match = None
+        if self.lastLegIndex is not None:
+            match = self._closestMatch(pt, self._windowSegments())
+            if match is not None and match.distance > maxDistance:
+                match = None
+        if match is None:
+            match = self._closestMatch(pt, self._indexedSegments(pt, maxDistance))
+            if match is not None and match.distance > maxDistance:
+                match = None
+        if match is not None:
+            self.lastLegIndex = match.legIndex
+            self.lastSegment = match.segment
+        return match
+
+    def _windowSegments(self):
+        legs = self.route.legs
+        legIndex = self.lastLegIndex
+        segment = max(1, self.lastSegment - SEARCH_WINDOW_BEHIND)
+        remaining = SEARCH_WINDOW_BEHIND + SEARCH_WINDOW_AHEAD + 1
+        while legIndex < len(legs) and remaining > 0:
+            npoints = legs[legIndex].pointCount()
+            while segment < npoints and remaining > 0:
+                yield legIndex, segment
+                segment += 1
+                remaining -= 1
+            legIndex += 1
+            segment = 1
+
+    def _indexedSegments(self, pt, maxDistance):
+        if self._index is None:
+            self._buildIndex()
+        dy = maxDistance / METERS_PER_DEGREE
+        dx = dy / max(math.cos(math.radians(pt.y())), 0.01)
+        rect = QgsRectangle(pt.x() - dx, pt.y() - dy, pt.x() + dx, pt.y() + dy)
+        return [self._segments[fid] for fid in sorted(self._index.intersects(rect))]
+
+    def _buildIndex(self):
+        self._index = QgsSpatialIndex()
+        self._segments = []
+        for legIndex, leg in enumerate(self.route.legs):
+            for segment in range(1, leg.pointCount()):
+                pt1 = leg.point(segment - 1)
+                pt2 = leg.point(segment)
+                rect = QgsRectangle(pt1, pt2)
+                self._index.addFeature(len(self._segments), rect)
+                self._segments.append((legIndex, segment))
+
+    def _closestMatch(self, pt, segments):
+        # Candidates are compared in a local equirectangular approximation,
+        # only the retained one is measured on the ellipsoid
+        scale = math.cos(math.radians(pt.y()))
+        best = None
+        bestSqrDist = None
+        for legIndex, segment in segments:
+            leg = self.route.legs[legIndex]
+            x, y, sqrDist = _closestPointOnSegment(
+                pt, leg.point(segment - 1), leg.point(segment), scale
+            )
+            if bestSqrDist is None or sqrDist < bestSqrDist:
+                best = (legIndex, segment, QgsPointXY(x, y))
+                bestSqrDist = sqrDist
+        if best is None:
+            return None
+        legIndex, segment, closest = best
+        return RouteMatch(
+            legIndex, segment, closest, measureMeters(self.qgsdistance, pt, closest)
+        )
+
+
+def _closestPointOnSegment(pt, pt1, pt2, scale):
+    ax = pt1.x() * scale
+    ay = pt1.y()
+    dx = pt2.x() * scale - ax
+    dy = pt2.y() - ay
+    px = pt.x() * scale
+    py = pt.y()
+    sqrLength = dx * dx + dy * dy
+    if sqrLength == 0:
+        t = 0
+    else:
+        t = min(1.0, max(0.0, ((px - ax) * dx + (py - ay) * dy) / sqrLength))
+    cx = ax + t * dx
+    cy = ay + t * dy
+    return cx / scale, cy, (px - cx) ** 2 + (py - cy) ** 2
@@ -0,0 +1,224 @@
+import math
+import logging
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+
+from PyQt5.QtCore import QByteArray
+from PyQt5.QtGui import QColor
+
+from qgis.core import (
+    Qgis,
+    QgsProject,
+    QgsSettings,
+    QgsPointXY,
+    QgsRectangle,
+    QgsRasterBlock,
+    QgsRasterFileWriter,
+    QgsRasterLayer,
+    QgsRasterShader,
+    QgsColorRampShader,
+    QgsSingleBandPseudoColorRenderer,
+    QgsCoordinateReferenceSystem,
+)
+
+from kadasrouting.utilities import waitcursor, tr
+from kadasrouting.valhalla.client import ValhallaClient
+from kadasrouting.core.routemodel import METERS_PER_DEGREE
+
+LOG = logging.getLogger(__name__)
+
+# Number of targets in a sources_to_targets request, as the bundled Valhalla
+# configuration accepts at most 50 locations (source included)
+SURFACE_TARGETS_PER_REQUEST = 49
+SURFACE_MAX_WORKERS = 4
+# Default size of the cells (in meters), made larger when needed to keep the
+# grid within SURFACE_MAX_CELLS cells per side
+SURFACE_CELL_SIZE = 250
+SURFACE_MAX_CELLS = 101
+# Speed (in km/h) used to estimate how far the largest time interval can
+# reach when the costing options do not give one, per profile
+SURFACE_DEFAULT_SPEED = 120
+SURFACE_PROFILE_SPEEDS = {"pedestrian": 5.1, "bicycle": 25}
+# Costing options holding the speed (in km/h) of each kind of profile
+SURFACE_SPEED_OPTIONS = ("top_speed", "cycling_speed", "walking_speed")
+# max_matrix_distance (in meters) of the bundled Valhalla configuration
+SURFACE_MATRIX_DISTANCES = {"pedestrian": 200000, "bicycle": 200000, "motorcycle": 200000}
+SURFACE_DEFAULT_MATRIX_DISTANCE = 400000
+# Number of raster rows written at once
+SURFACE_BLOCK_ROWS = 32
+SURFACE_NODATA = -1.0
+
+
+def _surfaceSpeed(profile, costingOptions):
+    """Speed (in km/h) of the vehicle, from its costing options if set"""
+    for option in SURFACE_SPEED_OPTIONS:
+        try:
+            return float(costingOptions[option])
+        except (KeyError, TypeError, ValueError):
+            pass
+    return SURFACE_PROFILE_SPEEDS.get(profile, SURFACE_DEFAULT_SPEED)
+
+
+def _surfaceRadius(intervals, profile, costingOptions):
+    """
+    Radius in meters of the area that can be reached within the intervals,
+    at most the distance Valhalla accepts in a matrix request for the profile
+    """
+    if costingOptions.get("shortest"):
+        # intervals in km
+        radius = max(intervals) * 1000
+    else:
+        # intervals in minutes
+        radius = max(intervals) / 60 * _surfaceSpeed(profile, costingOptions) * 1000
+    return min(
+        radius, SURFACE_MATRIX_DISTANCES.get(profile, SURFACE_DEFAULT_MATRIX_DISTANCE)
+    )
+
+
+def _grid(center, radius):
+    """
+    Returns the number of cells per side, the cell size (in degrees) along
+    x and y and the extent of a square grid centered on the center.
+    """
+    cellSize = float(
+        QgsSettings().value("/kadasrouting/surface_cell_size", SURFACE_CELL_SIZE)
+    )
+    halfCells = min(math.ceil(radius / cellSize), SURFACE_MAX_CELLS // 2)
+    cells = 2 * halfCells + 1
+    cellSize = max(cellSize, 2 * radius / cells)
+    dy = cellSize / METERS_PER_DEGREE
+    dx = dy / max(math.cos(math.radians(center.y())), 0.01)
+    extent = QgsRectangle(
+        center.x() - dx * cells / 2,
+        center.y() - dy * cells / 2,
+        center.x() + dx * cells / 2,
+        center.y() + dy * cells / 2,
+    )
+    return cells, dx, dy, extent
+
+
+def computeTravelSurface(center, profile, costingOptions, intervals):
+    """
+    Computes the travel time (in minutes), or distance (in km) in
+    isodistance mode, from a point to the centers of the cells of a grid
+    around it. The grid covers the area that can be reached within the
+    largest interval, cells outside of it or that can not be reached are set
+    to SURFACE_NODATA.
+
+    :returns: The number of cells per side, the extent of the grid and the
+        values of the cells, row by row from the top one
+    :rtype: (int, QgsRectangle, array)
+    """
+    radius = _surfaceRadius(intervals, profile, costingOptions)
+    cells, dx, dy, extent = _grid(center, radius)
+    maxValue = max(intervals)
+    values = array("f", [SURFACE_NODATA]) * (cells * cells)
+
+    # only the cells within the radius are computed
+    half = cells // 2
+    indexes = []
+    targets = []
+    for row in range(cells):
+        for col in range(cells):
+            if (row - half) ** 2 + (col - half) ** 2 > (half + 0.5) ** 2:
+                continue
+            indexes.append(row * cells + col)
+            targets.append(
+                QgsPointXY(
+                    extent.xMinimum() + (col + 0.5) * dx,
+                    extent.yMaximum() - (row + 0.5) * dy,
+                )
+            )
+    batches = [
+        range(start, min(start + SURFACE_TARGETS_PER_REQUEST, len(targets)))
+        for start in range(0, len(targets), SURFACE_TARGETS_PER_REQUEST)
+    ]
+    LOG.debug(
+        "computing travel surface of {} cells in {} requests".format(
+            len(targets), len(batches)
+        )
+    )
+
+    valhalla = ValhallaClient.getInstance()
+
+    def matrixForBatch(batch):
+        return valhalla.matrix(
+            center, [targets[i] for i in batch], profile, costingOptions
+        )
+
+    with ThreadPoolExecutor(max_workers=SURFACE_MAX_WORKERS) as executor:
+        for batch, result in zip(batches, executor.map(matrixForBatch, batches)):
+            for item in result[0]:
+                if costingOptions.get("shortest"):
+                    value = item.get("distance")
+                else:
+                    value = item.get("time")
+                    if value is not None:
+                        value = value / 60
+                if value is not None and value <= maxValue:
+                    values[indexes[batch[item["to_index"]]]] = value
+    return cells, extent, values
+
+
+def writeTravelSurface(filename, cells, extent, values):
+    """Writes the values of a travel surface to a GeoTIFF, by blocks of rows"""
+    writer = QgsRasterFileWriter(filename)
+    writer.setOutputFormat("GTiff")
+    provider = writer.createOneBandRaster(
+        Qgis.Float32, cells, cells, extent, QgsCoordinateReferenceSystem(4326)
+    )
+    if provider is None or not provider.isValid():
+        raise Exception(
+            tr("Could not create raster {filename}").format(filename=filename)
+        )
+    provider.setNoDataValue(1, SURFACE_NODATA)
+    provider.setEditable(True)
+    for row in range(0, cells, SURFACE_BLOCK_ROWS):
+        rows = min(SURFACE_BLOCK_ROWS, cells - row)
+        block = QgsRasterBlock(Qgis.Float32, cells, rows)
+        block.setData(
+            QByteArray(values[row * cells: (row + rows) * cells].tobytes())
+        )
+        if not provider.writeBlock(block, 1, 0, row):
+            raise Exception(
+                tr("Could not write raster {filename}").format(filename=filename)
+            )
+    provider.setEditable(False)
+    del provider
+
+
+def _surfaceRenderer(layer, intervals, colors):
+    """A renderer with the color of the smallest interval each cell is within"""
+    items = [
+        QgsColorRampShader.ColorRampItem(interval, QColor("#" + color), str(interval))
+        for interval, color in zip(intervals, colors)
+    ]
+    rampShader = QgsColorRampShader()
+    rampShader.setColorRampType(QgsColorRampShader.Discrete)
+    rampShader.setColorRampItemList(items)
+    shader = QgsRasterShader()
+    shader.setRasterShaderFunction(rampShader)
+    return QgsSingleBandPseudoColorRenderer(layer.dataProvider(), 1, shader)
+
+
+@waitcursor
+def generateTravelSurface(
+    point, profile, costingOptions, intervals, colors, basename, filename
+):
+    """
+    Computes the travel time (or distance) surface around a point, writes it
+    to a GeoTIFF and adds it to the project, colored by interval.
+    """
+    cells, extent, values = computeTravelSurface(
+        point, profile, costingOptions, intervals
+    )
+    writeTravelSurface(filename, cells, extent, values)
+    layer = QgsRasterLayer(filename, basename)
+    if not layer.isValid():
+        raise Exception(
+            tr("Could not load raster {filename}").format(filename=filename)
+        )
+    if len(colors) == len(intervals):
+        layer.setRenderer(_surfaceRenderer(layer, intervals, colors))
+    QgsProject.instance().addMapLayer(layer)
+    return layer
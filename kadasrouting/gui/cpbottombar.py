@@ -12,6 +12,7 @@ from kadasrouting.gui.valhallaroutebottombar import ValhallaRouteBottomBar
 from kadasrouting.gui.drawpolygonmaptool import DrawPolygonMapTool
 from kadasrouting.utilities import pushWarning, transformToWGS
 from kadasrouting.core.canvaslayersaver import CanvasLayerSaver
+from kadasrouting.core.memorylayersaver import ensureLayerLoaded
 
 
 # Royal Blue
@@ -125,6 +126,7 @@ class CPBottomBar(ValhallaRouteBottomBar, WIDGET):
             if patrolLayer is not None:
                 layerCrs = patrolLayer.crs()
                 transformer = transformToWGS(layerCrs)
+                ensureLayerLoaded(patrolLayer)
                 patrolFeatures = [f for f in patrolLayer.getFeatures()]
                 if len(patrolFeatures) != 1:
                     pushWarning(
@@ -152,7 +154,18 @@ class CPBottomBar(ValhallaRouteBottomBar, WIDGET):
         if patrolArea:
             patrolAreaJson = json.loads(patrolArea.asJson())
             patrolAreaWGS = []
-            polygon = patrolAreaJson["coordinates"][0]
+            if patrolAreaJson["type"] == "MultiPolygon":
+                # e.g. the layers saved from the canvas, which are multipolygons
+                if len(patrolAreaJson["coordinates"]) != 1:
+                    pushWarning(
+                        self.tr(
+                            "The polygon for Patrol must have a single part, it has {count}."
+                        ).format(count=len(patrolAreaJson["coordinates"]))
+                    )
+                    return
+                polygon = patrolAreaJson["coordinates"][0][0]
+            else:
+                polygon = patrolAreaJson["coordinates"][0]
             for point in polygon:
                 pointWGS = transformer.transform(point[0], point[1])
                 patrolAreaWGS.append([pointWGS.x(), pointWGS.y()])
@@ -18,6 +18,7 @@ from PyQt5.QtWidgets import QListWidgetItem, QListWidget, QLabel, QInputDialog
 from qgis.utils import iface
 
 from qgis.core import (
+    QgsApplication,
     QgsProject,
     QgsCoordinateTransform,
     QgsCoordinateReferenceSystem,
@@ -43,6 +44,8 @@ from kadas.kadasgui import (
 
 from kadasrouting.utilities import formatdist, pushMessage, iconPath
 from kadasrouting.core.optimalroutelayer import OptimalRouteLayer, NotInRouteException
+from kadasrouting.core.reroute import OffRouteDetector, RerouteTask
+from kadasrouting.core.memorylayersaver import ensureLayerLoaded
 from kadasrouting.gui.gps import getGpsConnection
 from kadasrouting.core import vehicles
 from kadasrouting.utilities import tr
@@ -275,6 +278,8 @@ class NavigationPanel(BASE, WIDGET):
         self.listWaypoints.setSpacing(5)
         self.waypointWidgets = []
         self.optimalRoutesCache = {}
+        self.offRouteDetector = OffRouteDetector()
+        self.rerouteTask = None
 
         self.timer = QTimer()
 
@@ -353,6 +358,7 @@ class NavigationPanel(BASE, WIDGET):
             isinstance(layer, QgsVectorLayer)
             and layer.geometryType() == QgsWkbTypes.LineGeometry
         ):
+            ensureLayerLoaded(layer)
             feature = next(layer.getFeatures(), None)
             if feature:
                 geom = feature.geometry()
@@ -365,11 +371,23 @@ class NavigationPanel(BASE, WIDGET):
         if hasattr(layer, "valhalla") and layer.hasRoute():
             try:
                 maneuver = layer.maneuverForPoint(point, gpsinfo.speed)
+                self.offRouteDetector.onRoute(maneuver["closest_point"])
                 self.refreshCanvas(maneuver["closest_point"], gpsinfo)
                 LOG.debug(maneuver)
             except NotInRouteException:
                 self.refreshCanvas(point, gpsinfo)
-                self.setMessage(self.tr("You are not on the route"))
+                if (
+                    self.offRouteDetector.offRoute(point)
+                    and self.rerouteTask is None
+                    and layer.canReroute()
+                ):
+                    self.startReroute(layer, point)
+                if self.rerouteTask is not None:
+                    self.setMessage(
+                        self.tr("You are not on the route, computing a new route...")
+                    )
+                else:
+                    self.setMessage(self.tr("You are not on the route"))
                 return
             self.setWidgetsVisibility(False)
             html = route_html_template.format(**maneuver)
@@ -416,6 +434,25 @@ class NavigationPanel(BASE, WIDGET):
             self.stopNavigation()
             return
 
+    def startReroute(self, layer, point):
+        self.rerouteTask = RerouteTask(layer, layer.reroutePoints(point))
+        self.rerouteTask.taskCompleted.connect(self.rerouteFinished)
+        self.rerouteTask.taskTerminated.connect(self.rerouteFinished)
+        QgsApplication.taskManager().addTask(self.rerouteTask)
+
+    def rerouteFinished(self):
+        self.rerouteTask = None
+        self.offRouteDetector.reset()
+
+    def cancelReroute(self):
+        if self.rerouteTask is not None:
+            try:
+                self.rerouteTask.cancel()
+            except RuntimeError as e:
+                # the task has already been deleted by the task manager
+                LOG.debug(e)
+            self.rerouteTask = None
+
     def refreshCanvas(self, point, gpsinfo):
         canvasPoint = self.transform.transform(point)
         self.centerPin.setPosition(KadasItemPos(point.x(), point.y()))
@@ -563,6 +600,7 @@ class NavigationPanel(BASE, WIDGET):
         self.centerPin = None
         self.waypointLayer = None
         self.warningShown = False
+        self.offRouteDetector.reset()
         self.originalGpsMarker = None
 
         self.setMessage(self.tr("Connecting to GPS..."))
@@ -608,9 +646,12 @@ class NavigationPanel(BASE, WIDGET):
     def currentLayerChanged(self, layer):
         self.waypointLayer = None
         self.warningShown = False
+        self.cancelReroute()
+        self.offRouteDetector.reset()
         self.updateNavigationInfo()
 
     def stopNavigation(self):
+        self.cancelReroute()
         if self.gpsConnection is not None:
             try:
                 self.timer.timeout.disconnect(self.updateNavigationInfo)
@@ -2,9 +2,12 @@ import os
 import logging
 import json
 
+from functools import partial
+
 from PyQt5 import uic
-from PyQt5.QtGui import QIcon
-from PyQt5.QtWidgets import QDesktopWidget
+from PyQt5.QtCore import QTimer
+from PyQt5.QtGui import QIcon, QColor
+from PyQt5.QtWidgets import QDesktopWidget, QFileDialog
 
 from kadas.kadasgui import KadasBottomBar
 
@@ -16,23 +19,61 @@ from kadasrouting.core import vehicles
 from kadasrouting.utilities import iconPath, pushMessage, pushWarning
 
 from qgis.core import (
+    QgsApplication,
     QgsProject,
+    QgsSettings,
     QgsCoordinateReferenceSystem,
     QgsCoordinateTransform,
     QgsRectangle,
+    QgsVectorLayer,
+    QgsWkbTypes,
 )
+from qgis.gui import QgsRubberBand
 
-from kadasrouting.core.isochroneslayer import generateIsochrones, OverwriteError
+from kadasrouting.core.isochroneslayer import (
+    generateIsochrones,
+    generateIsochronesForLayer,
+    OverwriteError,
+)
+from kadasrouting.core.isochronespreview import IsochronesPreviewTask
+from kadasrouting.core.travelsurface import generateTravelSurface
 
 from kadasrouting.exceptions import Valhalla400Exception
 
 LOG = logging.getLogger(__name__)
 
+# Time (in ms) without changes in the map or the parameters before a new
+# isochrones preview is computed
+PREVIEW_DELAY = 700
+
 WIDGET, BASE = uic.loadUiType(
     os.path.join(os.path.dirname(__file__), "reachabilitybottombar.ui")
 )
 
 
+def gradientColors(count, first, middle, last):
+    """
+    Returns count colors (as hex strings without #) going linearly from the
+    first color to the middle one and then to the last one.
+    """
+    stops = [QColor("#" + c) for c in (first, middle, last)]
+    colors = []
+    for i in range(count):
+        position = 2.0 * i / max(count - 1, 1)
+        start = min(int(position), 1)
+        ratio = position - start
+        color1 = stops[start]
+        color2 = stops[start + 1]
+        colors.append(
+            "{:02X}{:02X}{:02X}".format(
+                round(color1.red() + (color2.red() - color1.red()) * ratio),
+                round(color1.green() + (color2.green() - color1.green()) * ratio),
+                round(color1.blue() + (color2.blue() - color1.blue()) * ratio),
+            )
+        )
+    return colors
+
+
 class ReachabilityBottomBar(KadasBottomBar, WIDGET):
     def __init__(self, canvas, action):
         KadasBottomBar.__init__(self, canvas, "orange")
@@ -41,6 +82,14 @@ class ReachabilityBottomBar(KadasBottomBar, WIDGET):
         self.action = action
         self.canvas = canvas
 
+        self.previewTask = None
+        self.previewTasks = []
+        self.previewRubberBands = []
+        self.previewTimer = QTimer(self)
+        self.previewTimer.setSingleShot(True)
+        self.previewTimer.setInterval(PREVIEW_DELAY)
+        self.previewTimer.timeout.connect(self.startPreview)
+
         self.btnClose.setIcon(QIcon(":/kadas/icons/close"))
         self.btnClose.setToolTip(self.tr("Close reachability dialog"))
 
@@ -60,6 +109,9 @@ class ReachabilityBottomBar(KadasBottomBar, WIDGET):
 
         self.comboBoxVehicles.addItems(vehicles.vehicle_names())
 
+        self.populateCentersSelector()
+        self.comboBoxCenters.currentIndexChanged.connect(self.centersChanged)
+
         self.reachabilityMode = {
             "isochrone": self.tr("Isochrone"),
             "isodistance": self.tr("Isodistance"),
@@ -73,6 +125,33 @@ class ReachabilityBottomBar(KadasBottomBar, WIDGET):
         self.setIntervalToolTip()
         self.setBasename()
 
+        self.outputTypes = {
+            "polygons": self.tr("Polygons"),
+            "surface": self.tr("Travel time surface (raster)"),
+        }
+        self.comboBoxOutput.addItems(self.outputTypes.values())
+
+        self.spinBoxGeneralize.setValue(
+            int(QgsSettings().value("/kadasrouting/isochrones_generalize", 0))
+        )
+        self.spinBoxDenoise.setValue(
+            float(QgsSettings().value("/kadasrouting/isochrones_denoise", 1.0))
+        )
+        self.spinBoxSimplify.setValue(
+            int(QgsSettings().value("/kadasrouting/isochrones_simplify", 0))
+        )
+        self.spinBoxGeneralize.setToolTip(
+            self.tr("Tolerance used by the routing engine to generalize the polygons")
+        )
+        self.spinBoxDenoise.setToolTip(
+            self.tr(
+                "Polygons smaller than this ratio of the largest polygon of an interval are removed"
+            )
+        )
+        self.spinBoxSimplify.setToolTip(
+            self.tr("Tolerance used to simplify the polygons, keeping them nested")
+        )
+
         self.lineEditIntervals.textChanged.connect(self.intervalChanges)
         self.intervalChanges()
         self.lineEditBasename.textChanged.connect(self.basenameChanges)
@@ -84,6 +163,14 @@ class ReachabilityBottomBar(KadasBottomBar, WIDGET):
         # Update the point when the canvas extent changed.
         self.canvas.extentsChanged.connect(self.setCenterAsSelected)
 
+        # Live preview of the isochrones around the selected location
+        self.checkBoxLivePreview.toggled.connect(self.livePreviewToggled)
+        self.lineEditIntervals.textChanged.connect(self.schedulePreview)
+        self.comboBoxReachabilityMode.currentIndexChanged.connect(
+            self.schedulePreview
+        )
+        self.comboBoxVehicles.currentIndexChanged.connect(self.schedulePreview)
+
         # Always set to center of map for the first time
         self.setCenterAsSelected()
 
@@ -92,10 +179,135 @@ class ReachabilityBottomBar(KadasBottomBar, WIDGET):
         if size.width() >= 3200 or size.height() >= 1800:
             self.setFixedSize(self.size().width(), self.size().height() * 1.5)
 
+    def populateCentersSelector(self):
+        """Fill the centers combo box with the selected location and the point layers"""
+        self.comboBoxCenters.blockSignals(True)
+        currentLayer = self.comboBoxCenters.currentData()
+        self.comboBoxCenters.clear()
+        self.comboBoxCenters.addItem(self.tr("Selected location"), None)
+        for layer in QgsProject.instance().mapLayers().values():
+            if (
+                isinstance(layer, QgsVectorLayer)
+                and layer.geometryType() == QgsWkbTypes.PointGeometry
+            ):
+                self.comboBoxCenters.addItem(layer.name(), layer)
+                if layer == currentLayer:
+                    self.comboBoxCenters.setCurrentIndex(
+                        self.comboBoxCenters.count() - 1
+                    )
+        self.comboBoxCenters.blockSignals(False)
+        self.centersChanged()
+
+    def centersChanged(self):
+        self.originSearchBox.setEnabled(self.comboBoxCenters.currentData() is None)
+        self.schedulePreview()
+
     def setCenterAsSelected(self, point=None):
         """Set the current center of the map as the selected point"""
         map_center = self.canvas.center()
         self.originSearchBox.updatePoint(map_center, None)
+        self.schedulePreview()
+
+    def livePreviewToggled(self, checked):
+        if checked:
+            self.schedulePreview()
+        else:
+            self.cancelPreview()
+            self.clearPreview()
+
+    def schedulePreview(self):
+        """
+        (Re)starts the countdown before computing a new preview, so a preview
+        is only computed once the user stops panning or editing. A preview
+        being computed is canceled, as it is stale now.
+        """
+        self.cancelPreview()
+        if (
+            self.checkBoxLivePreview.isChecked()
+            and self.comboBoxCenters.currentData() is None
+        ):
+            self.previewTimer.start()
+
+    def startPreview(self):
+        try:
+            point = self.originSearchBox.point
+            intervals = self.getInterval()
+        except Exception as e:
+            LOG.debug("No isochrones preview: %s" % e)
+            return
+        if not intervals:
+            return
+        profile, costingOptions = self.getProfileAndCostingOptions()
+        task = IsochronesPreviewTask(
+            point, profile, costingOptions, intervals, self.getColorFromInterval()
+        )
+        task.taskCompleted.connect(partial(self.previewFinished, task))
+        task.taskTerminated.connect(partial(self.previewFinished, task))
+        # keep a reference to the canceled tasks until they are finished
+        self.previewTasks.append(task)
+        self.previewTask = task
+        QgsApplication.taskManager().addTask(task)
+
+    def previewFinished(self, task):
+        if task in self.previewTasks:
+            self.previewTasks.remove(task)
+        if task is not self.previewTask:
+            return
+        self.previewTask = None
+        if task.isochrones is None or not self.checkBoxLivePreview.isChecked():
+            return
+        self.clearPreview()
+        for interval, color, geometry in task.isochrones:
+            rubberBand = QgsRubberBand(self.canvas, QgsWkbTypes.PolygonGeometry)
+            rubberBand.setToGeometry(geometry, QgsCoordinateReferenceSystem(4326))
+            strokeColor = QColor("#" + color.lstrip("#")) if color else QColor(0, 0, 0)
+            fillColor = QColor(strokeColor)
+            fillColor.setAlpha(64)
+            rubberBand.setStrokeColor(strokeColor)
+            rubberBand.setFillColor(fillColor)
+            rubberBand.setWidth(2)
+            self.previewRubberBands.append(rubberBand)
+
+    def cancelPreview(self):
+        self.previewTimer.stop()
+        if self.previewTask is not None:
+            try:
+                self.previewTask.cancel()
+            except RuntimeError as e:
+                # the task has already been deleted
+                LOG.debug(e)
+            self.previewTask = None
+
+    def clearPreview(self):
+        for rubberBand in self.previewRubberBands:
+            self.canvas.scene().removeItem(rubberBand)
+        self.previewRubberBands = []
+
+    def getPolygonOptions(self):
+        """Returns the options of the isochrone polygons and stores them in the settings"""
+        generalize = self.spinBoxGeneralize.value()
+        denoise = self.spinBoxDenoise.value()
+        simplify = self.spinBoxSimplify.value()
+        QgsSettings().setValue("/kadasrouting/isochrones_generalize", generalize)
+        QgsSettings().setValue("/kadasrouting/isochrones_denoise", denoise)
+        QgsSettings().setValue("/kadasrouting/isochrones_simplify", simplify)
+        return {
+            # 0 means the default generalization of the routing engine
+            "generalize": generalize or None,
+            "denoise": denoise,
+            "simplify": simplify,
+        }
+
+    def getProfileAndCostingOptions(self):
+        vehicle = self.comboBoxVehicles.currentIndex()
+        profile, costingOptions = vehicles.options_for_vehicle(vehicle)
+
+        is_isodistance = (
+            self.comboBoxReachabilityMode.currentText()
+            == self.reachabilityMode["isodistance"]
+        )
+        costingOptions["shortest"] = is_isodistance
+        return profile, costingOptions
 
     def centerMap(self):
         """Pan map so that the current selected point as the center of the map canvas."""
@@ -125,46 +337,61 @@ class ReachabilityBottomBar(KadasBottomBar, WIDGET):
     def calculate(self):
         overwrite = self.checkBoxRemovePrevious.isChecked()
         LOG.debug("isochrones layer name = {}".format(self.getBasename()))
-        try:
-            point = self.originSearchBox.point
-        except WrongLocationException as e:
-            pushWarning(
-                self.tr("Invalid location: {error_message}").format(
-                    error_message=str(e)
+        centerLayer = self.comboBoxCenters.currentData()
+        point = None
+        if centerLayer is None:
+            try:
+                point = self.originSearchBox.point
+            except WrongLocationException as e:
+                pushWarning(
+                    self.tr("Invalid location: {error_message}").format(
+                        error_message=str(e)
+                    )
                 )
-            )
-            return
+                return
         try:
             intervals = self.getInterval()
-            if not (1 <= len(intervals) <= 10):
-                raise Exception(
-                    self.tr("Must have at least one and maximum 10 intervals.")
-                )
+            if len(intervals) < 1:
+                raise Exception(self.tr("Must have at least one interval."))
         except Exception as e:
             pushWarning("Invalid intervals: %s" % str(e))
             return
 
-        vehicle = self.comboBoxVehicles.currentIndex()
-        profile, costingOptions = vehicles.options_for_vehicle(vehicle)
+        profile, costingOptions = self.getProfileAndCostingOptions()
 
-        is_isodistance = (
-            self.comboBoxReachabilityMode.currentText()
-            == self.reachabilityMode["isodistance"]
-        )
-        costingOptions["shortest"] = is_isodistance
+        # the preview is replaced by the isochrones layer
+        self.cancelPreview()
+        self.clearPreview()
 
         colors = []
         try:
             colors = self.getColorFromInterval()
-            generateIsochrones(
-                point,
-                profile,
-                costingOptions,
-                intervals,
-                colors,
-                self.getBasename(),
-                overwrite,
-            )
+            if self.comboBoxOutput.currentText() == self.outputTypes["surface"]:
+                self.calculateSurface(
+                    centerLayer, point, profile, costingOptions, intervals, colors
+                )
+            elif centerLayer is None:
+                generateIsochrones(
+                    point,
+                    profile,
+                    costingOptions,
+                    intervals,
+                    colors,
+                    self.getBasename(),
+                    overwrite,
+                    self.getPolygonOptions(),
+                )
+            else:
+                generateIsochronesForLayer(
+                    centerLayer,
+                    profile,
+                    costingOptions,
+                    intervals,
+                    colors,
+                    self.getBasename(),
+                    overwrite,
+                    self.getPolygonOptions(),
+                )
         except OverwriteError as e:
             LOG.error(e)
             pushWarning(
@@ -183,13 +410,44 @@ class ReachabilityBottomBar(KadasBottomBar, WIDGET):
             pushWarning("could not generate isochrones")
             raise Exception(e)
 
+    def calculateSurface(
+        self, centerLayer, point, profile, costingOptions, intervals, colors
+    ):
+        if centerLayer is not None:
+            pushWarning(
+                self.tr(
+                    "The travel time surface can only be computed for the selected location"
+                )
+            )
+            return
+        filename, _ = QFileDialog.getSaveFileName(
+            self,
+            self.tr("Save travel time surface"),
+            "",
+            self.tr("GeoTIFF (*.tif)"),
+        )
+        if not filename:
+            return
+        generateTravelSurface(
+            point,
+            profile,
+            costingOptions,
+            intervals,
+            colors,
+            self.getBasename(),
+            filename,
+        )
+
     def actionToggled(self, toggled):
         if toggled:
+            self.populateCentersSelector()
             self.setCenterAsSelected()
             # Update the point when the canvas extent changed.
             self.canvas.extentsChanged.connect(self.setCenterAsSelected)
             self.originSearchBox.pointUpdated.connect(self.centerMap)
         else:
+            self.cancelPreview()
+            self.clearPreview()
             self.originSearchBox.removePin()
             # Disconnect the signal to avoid the blue cross shown up
             try:
@@ -249,8 +507,6 @@ class ReachabilityBottomBar(KadasBottomBar, WIDGET):
             interval = self.getInterval()
             if len(interval) == 0:
                 raise Exception(self.tr("Interval can not be empty"))
-            if len(interval) > 10:
-                raise Exception(self.tr("Interval can not be more than 10"))
             self.lineEditIntervals.setStyleSheet("color: black;")
             self.btnCalculate.setEnabled(True)
             self.btnCalculate.setToolTip("")
@@ -378,5 +634,5 @@ class ReachabilityBottomBar(KadasBottomBar, WIDGET):
             ],
         }
         if num_interval not in colors.keys():
-            return []
+            return gradientColors(num_interval, first_color, "CCCC00", last_color)
         return colors[num_interval]
@@ -16,6 +16,7 @@ from kadasrouting.gui.locationinputwidget import (
 )
 from kadasrouting.core import vehicles
 from kadasrouting.core.canvaslayersaver import CanvasLayerSaver
+from kadasrouting.core.memorylayersaver import ensureLayerLoaded
 from kadasrouting.utilities import iconPath, pushWarning, transformToWGS
 
 from qgis.utils import iface
@@ -242,6 +243,7 @@ class ValhallaRouteBottomBar(KadasBottomBar):
             if avoidLayer is not None:
                 layerCrs = avoidLayer.crs()
                 transformer = transformToWGS(layerCrs)
+                ensureLayerLoaded(avoidLayer)
                 areasToAvoid = [f.geometry() for f in avoidLayer.getFeatures()]
             else:
                 # If polygon layer button is checked, but no layer polygon is selected
@@ -265,8 +267,17 @@ class ValhallaRouteBottomBar(KadasBottomBar):
         if areasToAvoid:
             for areasToAvoidGeom in areasToAvoid:
                 areasToAvoidJson = json.loads(areasToAvoidGeom.asJson())
+                if areasToAvoidJson["type"] == "MultiPolygon":
+                    # e.g. the layers saved from the canvas
+                    rings = [
+                        ring
+                        for polygon in areasToAvoidJson["coordinates"]
+                        for ring in polygon
+                    ]
+                else:
+                    rings = areasToAvoidJson["coordinates"]
                 areasToAvoidWGS = []
-                for i, polygon in enumerate(areasToAvoidJson["coordinates"]):
+                for i, polygon in enumerate(rings):
                     areasToAvoidWGS.append([])
                     for point in polygon:
                         pointWGS = transformer.transform(point[0], point[1])
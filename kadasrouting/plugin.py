@@ -23,6 +23,7 @@ from kadasrouting.gui.disclaimerdialog import DisclaimerDialog
 from kadasrouting.valhalla.client import ValhallaClient
 
 from kadasrouting.core.memorylayersaver import MemoryLayerSaver
+from kadasrouting.core.layerregistry import LayerRegistry
 
 logfile = os.path.join(os.path.expanduser("~"), ".kadas", "kadas-routing.log")
 try:
@@ -58,6 +59,9 @@ class RoutingPlugin(QObject):
         # auto saver for memory layers
         self._saver = MemoryLayerSaver(iface)
 
+        # index of the layers created by the plugin, following the project
+        LayerRegistry.getInstance()
+
     def initGui(self):
         # Routing menu
         self.optimalRouteAction = QAction(icon("routing.png"), self.tr("Routing"))
@@ -149,6 +153,7 @@ class RoutingPlugin(QObject):
             self.dayNightAction, self.iface.PLUGIN_MENU, self.iface.GPS_TAB
         )
         self._saver.detachFromProject()
+        LayerRegistry.reset()
 
     def _showPanel(self, action, show):
         function = self.actionsToggled[action]
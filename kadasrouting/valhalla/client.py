@@ -2,13 +2,29 @@
 
 # Code partially adapted from the QGIS - Valhalla plugin by Nils Nolde(nils@gis-ops.com)
 import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from qgis.core import QgsSettings
+
 from kadasrouting.exceptions import ValhallaException, Valhalla400Exception
 from kadasrouting.utilities import encodePolyline6
 
 from .connectors import ConsoleConnector
+from .mapmatching import thinPolyline, splitPolyline, stitchResponses
 
 LOG = logging.getLogger(__name__)
 
+# Polylines are map matched in chunks of MAPMATCHING_CHUNK_SIZE segments,
+# overlapping by MAPMATCHING_CHUNK_OVERLAP segments, matched concurrently
+MAPMATCHING_CHUNK_SIZE = 250
+MAPMATCHING_CHUNK_OVERLAP = 10
+MAPMATCHING_MAX_WORKERS = 4
+# Default minimum distance (in meters) between consecutive polyline vertices
+MAPMATCHING_INTERPOLATION_DISTANCE = 10
+# Maximum number of contours in an isochrones request, as set in the
+# service_limits of the Valhalla configuration
+ISOCHRONES_MAX_CONTOURS = 4
+
 
 class ValhallaClient:
 
@@ -60,32 +76,136 @@ class ValhallaClient:
             raise ValhallaException(str(e))
         return response
 
-    def isochrones(self, qgspoint, profile, costingOptions, intervals, colors):
+    def isochrones(
+        self,
+        qgspoint,
+        profile,
+        costingOptions,
+        intervals,
+        colors,
+        generalize=None,
+        denoise=None,
+    ):
+        """
+        Computes the isochrones around a point. More intervals than Valhalla
+        accepts in a request are computed in several requests, and their
+        features are merged in a single response.
+
+        :param generalize: tolerance in meters used by Valhalla to generalize
+            the polygons, or None for the default of Valhalla
+        :type generalize: float
+
+        :param denoise: value between 0 and 1 used by Valhalla to remove the
+            small polygons, relative to the largest one, or None for the
+            default of Valhalla
+        :type denoise: float
+        """
         points = self.pointsFromQgsPoints([qgspoint])
+        response = None
+        for start in range(0, len(intervals), ISOCHRONES_MAX_CONTOURS):
+            end = start + ISOCHRONES_MAX_CONTOURS
+            try:
+                batchResponse = self.connector.isochrones(
+                    points,
+                    profile,
+                    costingOptions,
+                    intervals[start:end],
+                    colors[start:end],
+                    generalize,
+                    denoise,
+                )
+            except Valhalla400Exception as e:
+                raise e
+            except Exception as e:
+                raise ValhallaException(str(e))
+            if response is None:
+                response = batchResponse
+            else:
+                response["features"].extend(batchResponse["features"])
+        return response
+
+    def matrix(self, qgspoint, targets, profile, costingOptions):
+        """
+        Computes the time and distance of the routes from a point to each of
+        the target points.
+
+        :param qgspoint: The source point
+        :type qgspoint: QgsPointXY
+
+        :param targets: The target points
+        :type targets: list of QgsPointXY
+
+        :returns: The sources_to_targets list of the response, with a single
+            list of {"time", "distance", "to_index"} dicts. The time and
+            distance are None for the targets that can not be reached.
+        """
         try:
-            response = self.connector.isochrones(
-                points, profile, costingOptions, intervals, colors
+            response = self.connector.matrix(
+                self.pointsFromQgsPoints([qgspoint]),
+                self.pointsFromQgsPoints(targets),
+                profile,
+                costingOptions,
             )
         except Valhalla400Exception as e:
             raise e
         except Exception as e:
             raise ValhallaException(str(e))
-        return response
+        return response["sources_to_targets"]
 
     def mapmatching(self, line, profile, costingOptions):
+        """
+        Computes the route that best matches a polyline.
+
+        Vertices closer than the interpolation distance set in the
+        /kadasrouting/mapmatching_interpolation_distance setting are removed
+        first. Long polylines are split in overlapping chunks that are matched
+        concurrently and stitched into a single route.
+
+        :param line: A list of QgsPointsXY in epsg4326 crs
+        :type line: list
+
+        :param profile: the costing profile to use
+        :type profile: string
+
+        :param costingOptions: The options for computing the route
+        :type costingOptions: dict
+        """
+        interpolationDistance = float(
+            QgsSettings().value(
+                "/kadasrouting/mapmatching_interpolation_distance",
+                MAPMATCHING_INTERPOLATION_DISTANCE,
+            )
+        )
+        line = thinPolyline(line, interpolationDistance)
         try:
-            pt = line[0]
-            shape = [{"lat": pt.y(), "lon": pt.x(), "type": "break"}]
-            for pt in line[1:-1]:
-                shape.append({"lat": pt.y(), "lon": pt.x(), "type": "via"})
-            pt = line[-1]
-            shape.append({"lat": pt.y(), "lon": pt.x(), "type": "break"})
-            response = self.connector.mapmatching(shape, profile, costingOptions)
+            if len(line) <= MAPMATCHING_CHUNK_SIZE + 1:
+                return self._mapmatchingShape(line, profile, costingOptions)
+            chunks = splitPolyline(
+                line, MAPMATCHING_CHUNK_SIZE, MAPMATCHING_CHUNK_OVERLAP
+            )
+            with ThreadPoolExecutor(max_workers=MAPMATCHING_MAX_WORKERS) as executor:
+                responses = list(
+                    executor.map(
+                        lambda chunk: self._mapmatchingShape(
+                            chunk[0], profile, costingOptions
+                        ),
+                        chunks,
+                    )
+                )
+            return stitchResponses(responses, chunks)
         except Valhalla400Exception as e:
             raise e
         except Exception as e:
             raise ValhallaException(str(e))
-        return response
+
+    def _mapmatchingShape(self, line, profile, costingOptions):
+        pt = line[0]
+        shape = [{"lat": pt.y(), "lon": pt.x(), "type": "break"}]
+        for pt in line[1:-1]:
+            shape.append({"lat": pt.y(), "lon": pt.x(), "type": "via"})
+        pt = line[-1]
+        shape.append({"lat": pt.y(), "lon": pt.x(), "type": "break"})
+        return self.connector.mapmatching(shape, profile, costingOptions)
 
     def polyline6fromQgsPolylineXY(self, qgsline):
         points = [(p.x(), p.y()) for p in qgsline]
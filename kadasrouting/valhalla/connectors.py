@@ -2,6 +2,8 @@ import os
 import subprocess
 import logging
 import json
+import tempfile
+import threading
 from jinja2 import Environment, FileSystemLoader
 
 from PyQt5.QtCore import QObject
@@ -13,6 +15,10 @@ from kadasrouting.core.datacatalogueclient import DataCatalogueClient
 
 LOG = logging.getLogger(__name__)
 
+# Requests can be run concurrently from worker threads, they share the
+# Valhalla configuration file
+_configLock = threading.Lock()
+
 
 class Connector(QObject):
     def isAvailable(self):
@@ -45,7 +51,9 @@ class Connector(QObject):
 
         return params
 
-    def prepareIsochronesParameters(self, points, profile, options, intervals, colors):
+    def prepareIsochronesParameters(
+        self, points, profile, options, intervals, colors, generalize=None, denoise=None
+    ):
         travel_constraint = "distance" if options.get('shortest') else "time"
         # build contour json
         if len(intervals) != len(colors):
@@ -66,8 +74,20 @@ class Connector(QObject):
             contours=contours,
             costing_options={profile: options},
         )
+        if generalize is not None:
+            params["generalize"] = generalize
+        if denoise is not None:
+            params["denoise"] = denoise
         return params
 
+    def prepareMatrixParameters(self, sources, targets, profile, options):
+        return {
+            "sources": sources,
+            "targets": targets,
+            "costing": profile,
+            "costing_options": {profile: options},
+        }
+
     def prepareMapmatchingParameters(self, shape, profile, options):
         return {
             "shape": shape,
@@ -82,10 +102,12 @@ class ConsoleConnector(Connector):
         return os.path.exists(self._valhallaExecutablePath())
 
     def createMapmatchingParametersFile(self, params):
-        outputFileName = os.path.join(appDataDir(), "params.json")
-        with open(outputFileName, "w") as f:
+        # a file per request, as several requests can be run at the same time
+        with tempfile.NamedTemporaryFile(
+            "w", dir=appDataDir(), prefix="params", suffix=".json", delete=False
+        ) as f:
             json.dump(params, f)
-        return outputFileName
+        return f.name
 
     def createValhallaJsonConfig(self, content):
         outputFileName = os.path.join(appDataDir(), "valhalla.json")
@@ -95,12 +117,20 @@ class ConsoleConnector(Connector):
         templateFileLoader = FileSystemLoader(templatePath)
         jinjaEnv = Environment(loader=templateFileLoader)
         valhallaConfigTemplate = jinjaEnv.get_template("valhalla.json.jinja")
-        with open(outputFileName, "w") as f:
-            f.write(
-                valhallaConfigTemplate.render(
-                    valhallaTilesDir=content["valhallaTilesDir"]
-                )
-            )
+        config = valhallaConfigTemplate.render(
+            valhallaTilesDir=content["valhallaTilesDir"]
+        )
+        with _configLock:
+            # only rewrite the file when it changes, another request might be
+            # reading it
+            try:
+                with open(outputFileName) as f:
+                    unchanged = f.read() == config
+            except OSError:
+                unchanged = False
+            if not unchanged:
+                with open(outputFileName, "w") as f:
+                    f.write(config)
         return outputFileName
 
     def _valhallaExecutablePath(self):
@@ -171,15 +201,25 @@ class ConsoleConnector(Connector):
             response = self._execute("route", json.dumps(params))
         return response
 
-    def isochrones(self, points, profile, options, intervals, colors):
+    def isochrones(
+        self, points, profile, options, intervals, colors, generalize=None, denoise=None
+    ):
         params = self.prepareIsochronesParameters(
-            points, profile, options, intervals, colors
+            points, profile, options, intervals, colors, generalize, denoise
         )
         response = self._execute("isochrone", json.dumps(params))
         return response
 
+    def matrix(self, sources, targets, profile, options):
+        params = self.prepareMatrixParameters(sources, targets, profile, options)
+        response = self._execute("sources_to_targets", json.dumps(params))
+        return response
+
     def mapmatching(self, shape, profile, options):
         params = self.prepareMapmatchingParameters(shape, profile, options)
         filename = self.createMapmatchingParametersFile(params)
-        response = self._execute("trace_route", filename)
+        try:
+            response = self._execute("trace_route", filename)
+        finally:
+            os.remove(filename)
         return response
@@ -0,0 +1,155 @@
+"""
+Helpers to map match long polylines: the polyline is thinned, split into
+overlapping chunks that are matched separately, and the matched chunks are
+stitched back into a single route.
+"""
+
+from kadasrouting.utilities import decodePolyline6, encodePolyline6
+from kadasrouting.core.routemodel import ellipsoidalDistanceArea, measureMeters
+
+DEPART_MANEUVER_TYPES = (1, 2, 3)
+ARRIVE_MANEUVER_TYPES = (4, 5, 6)
+
+
+def thinPolyline(line, interpolationDistance):
+    """
+    Returns the polyline without the vertices closer than
+    interpolationDistance meters to the previous kept vertex. The first and
+    last vertices are always kept.
+    """
+    if len(line) < 3 or interpolationDistance <= 0:
+        return list(line)
+    qgsdistance = ellipsoidalDistanceArea()
+    thinned = [line[0]]
+    for pt in line[1:-1]:
+        if measureMeters(qgsdistance, thinned[-1], pt) >= interpolationDistance:
+            thinned.append(pt)
+    thinned.append(line[-1])
+    return thinned
+
+
+def splitPolyline(line, chunkSize, overlap):
+    """
+    Splits a polyline in chunks of chunkSize segments. Each chunk but the
+    first one also starts with the last overlap segments of the previous
+    chunk, so the matcher has some context at the start of the chunk.
+
+    Returns a list of (chunk, cutIndex) tuples, where cutIndex is the index
+    of the vertex at which the chunk starts without its overlap.
+    """
+    chunks = []
+    start = 0
+    while start < len(line) - 1:
+        end = min(start + chunkSize, len(line) - 1)
+        first = max(0, start - overlap)
+        chunks.append((line[first: end + 1], start - first))
+        start = end
+    return chunks
+
+
+def _trimToPoint(coordinates, maneuvers, point, fraction):
+    """
+    Removes the part of a matched chunk before the shape vertex closest to
+    the given point. The point is searched in the start of the shape only,
+    twice as long as the given fraction of the chunk, as that is where the
+    overlap with the previous chunk is.
+    """
+    searched = min(len(coordinates), int(len(coordinates) * 2 * fraction) + 1)
+    cut = min(
+        range(searched),
+        key=lambda i: (coordinates[i][0] - point.y()) ** 2
+        + (coordinates[i][1] - point.x()) ** 2,
+    )
+    if cut == 0:
+        return coordinates, maneuvers
+    trimmed = []
+    for maneuver in maneuvers:
+        if maneuver["end_shape_index"] <= cut:
+            continue
+        maneuver = dict(maneuver)
+        begin = maneuver["begin_shape_index"]
+        end = maneuver["end_shape_index"]
+        if begin < cut:
+            # keep the share of the maneuver that is after the cut
+            ratio = (end - cut) / (end - begin)
+            maneuver["time"] = maneuver["time"] * ratio
+            maneuver["length"] = maneuver["length"] * ratio
+            begin = cut
+        maneuver["begin_shape_index"] = begin - cut
+        maneuver["end_shape_index"] = end - cut
+        trimmed.append(maneuver)
+    return coordinates[cut:], trimmed
+
+
+def _chunkFromResponse(response):
+    coordinates = []
+    maneuvers = []
+    for leg in response["trip"]["legs"]:
+        offset = len(coordinates)
+        coordinates.extend(decodePolyline6(leg["shape"]))
+        for maneuver in leg["maneuvers"]:
+            maneuver = dict(maneuver)
+            maneuver["begin_shape_index"] += offset
+            maneuver["end_shape_index"] += offset
+            maneuvers.append(maneuver)
+    return coordinates, maneuvers
+
+
+def stitchResponses(responses, chunks):
+    """
+    Stitches the responses of the matched chunks of a polyline into a single
+    response with one leg. The arrival maneuver of a chunk and the departure
+    maneuver of the next one are merged, so maneuvers are continuous along
+    the route.
+
+    :param chunks: the chunks returned by splitPolyline, in the same order
+        as the responses
+    """
+    coordinates = []
+    maneuvers = []
+    for i, response in enumerate(responses):
+        chunkCoordinates, chunkManeuvers = _chunkFromResponse(response)
+        if i == 0:
+            coordinates.extend(chunkCoordinates)
+            maneuvers.extend(chunkManeuvers)
+            continue
+        chunk, cutIndex = chunks[i]
+        chunkCoordinates, chunkManeuvers = _trimToPoint(
+            chunkCoordinates, chunkManeuvers, chunk[cutIndex], cutIndex / len(chunk)
+        )
+        if coordinates and chunkCoordinates[0] == coordinates[-1]:
+            chunkCoordinates = chunkCoordinates[1:]
+            offset = len(coordinates) - 1
+        else:
+            offset = len(coordinates)
+        coordinates.extend(chunkCoordinates)
+        if maneuvers and maneuvers[-1]["type"] in ARRIVE_MANEUVER_TYPES:
+            maneuvers.pop()
+        if maneuvers:
+            maneuvers[-1]["end_shape_index"] = offset
+        for j, maneuver in enumerate(chunkManeuvers):
+            maneuver["begin_shape_index"] += offset
+            maneuver["end_shape_index"] += offset
+            if j == 0 and maneuvers and maneuver["type"] in DEPART_MANEUVER_TYPES:
+                previous = maneuvers[-1]
+                previous["end_shape_index"] = maneuver["end_shape_index"]
+                previous["time"] += maneuver["time"]
+                previous["length"] += maneuver["length"]
+            else:
+                maneuvers.append(maneuver)
+
+    summary = {
+        "time": sum(m["time"] for m in maneuvers),
+        "length": sum(m["length"] for m in maneuvers),
+    }
+    trip = dict(responses[0]["trip"])
+    trip.pop("locations", None)
+    trip["legs"] = [
+        {
+            "shape": encodePolyline6(coordinates),
+            "maneuvers": maneuvers,
+            "summary": dict(summary),
+        }
+    ]
+    trip["summary"] = summary
+    return dict(responses[0], trip=trip)